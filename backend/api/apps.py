@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from api import (autocomplete, cache, matching,  # noqa: F401
+                         recipe_cache, recipe_state, search)
+        post_migrate.connect(
+            search.create_search_index,
+            sender=self.apps.get_app_config('recipes')
+        )
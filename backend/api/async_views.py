@@ -0,0 +1,60 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.urls import URLPattern
+from rest_framework.permissions import SAFE_METHODS
+
+from foodgram.db import close_unusable_connections
+
+
+def render_in_thread(view, request, *args, **kwargs):
+    """Выполняет DRF-вьюху и рендер ответа в потоке пула.
+
+    Соединения с базой в Django принадлежат потоку, поэтому поток сам
+    проверяет и закрывает устаревшие соединения, как обычный
+    WSGI-воркер.
+    """
+    close_old_connections()
+    close_unusable_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+def async_read_view(view):
+    """Оборачивает вьюху DRF в async-вьюху для ASGI.
+
+    В Django 3.2 нет асинхронного ORM, а sync-вьюхи под ASGI выполняются
+    по одной в общем потоке. Безопасные запросы здесь уходят в пул
+    потоков (thread_sensitive=False), так что медленная база или
+    файловый ввод-вывод одного запроса не держат остальные; цикл
+    событий воркера продолжает принимать соединения. Запись идёт
+    обычным путём Django для sync-вьюх.
+    """
+    read = sync_to_async(render_in_thread, thread_sensitive=False)
+    write = sync_to_async(view)
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return await read(view, request, *args, **kwargs)
+        return await write(request, *args, **kwargs)
+
+    return wrapper
+
+
+def async_read_urls(patterns, viewsets):
+    """Заменяет вьюхи указанных вьюсетов в маршрутах роутера."""
+    return [
+        URLPattern(
+            pattern.pattern, async_read_view(pattern.callback),
+            pattern.default_args, pattern.name
+        )
+        if getattr(pattern.callback, 'cls', None) in viewsets else pattern
+        for pattern in patterns
+    ]
@@ -0,0 +1,87 @@
+from bisect import bisect_left
+
+from api.cache import get_last_modified
+from recipes.models import Ingredient
+
+
+TRIGRAM = 3
+
+
+def get_trigrams(text):
+    return {text[i:i + TRIGRAM] for i in range(len(text) - TRIGRAM + 1)}
+
+
+class IngredientIndex:
+    """Индекс ингредиентов в памяти процесса для автодополнения.
+
+    Названия в нижнем регистре лежат в отсортированном массиве, поэтому
+    совпадения по началу строки находятся двоичным поиском как в
+    префиксном дереве. Совпадения по подстроке идут после них и ищутся
+    только для запросов от трёх символов: кандидаты берутся из самого
+    короткого списка по триграммам запроса, а не перебором каталога.
+    Индекс собран для поколения группы ingredients в общем кэше и
+    перестраивается, когда его сдвигают сигналы или load_ingredients
+    в любом процессе.
+    """
+
+    def __init__(self):
+        # Ключи, строки и триграммы меняются одним присваиванием
+        # кортежа, чтобы поиск в другом потоке не смешал две сборки.
+        self.entries = ((), (), {})
+        self.built_for = None
+
+    def invalidate(self):
+        self.built_for = None
+
+    def build(self, modified):
+        rows = sorted(
+            (
+                (name.lower(), {
+                    'id': pk,
+                    'name': name,
+                    'measurement_unit': unit,
+                })
+                for pk, name, unit in Ingredient.objects.values_list(
+                    'id', 'name', 'measurement_unit'
+                )
+            ),
+            key=lambda row: (row[0], row[1]['measurement_unit'])
+        )
+        keys = tuple(key for key, _ in rows)
+        trigrams = {}
+        for index, key in enumerate(keys):
+            for trigram in get_trigrams(key):
+                trigrams.setdefault(trigram, []).append(index)
+        self.entries = (keys, tuple(row for _, row in rows), trigrams)
+        self.built_for = modified
+
+    def search(self, query, limit=None):
+        modified = get_last_modified('ingredients')
+        if self.built_for != modified:
+            self.build(modified)
+        keys, rows, trigrams = self.entries
+        query = query.lower()
+
+        start = bisect_left(keys, query)
+        end = start
+        while end < len(keys) and keys[end].startswith(query):
+            end += 1
+        result = list(rows[start:end])
+        if ((limit is not None and len(result) >= limit)
+                or len(query) < TRIGRAM):
+            return result[:limit]
+
+        candidates = min(
+            (trigrams.get(trigram, ()) for trigram in get_trigrams(query)),
+            key=len
+        )
+        contains = sorted(
+            (keys[index].find(query), index)
+            for index in candidates
+            if query in keys[index] and not start <= index < end
+        )
+        result += [rows[index] for _, index in contains]
+        return result[:limit]
+
+
+ingredient_index = IngredientIndex()
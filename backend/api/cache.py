@@ -0,0 +1,92 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from foodgram.db import read_from_primary
+from recipes.models import Ingredient, Tag
+
+
+def get_modified_key(group):
+    return f'api:{group}:modified'
+
+
+def get_last_modified(group):
+    key = get_modified_key(group)
+    modified = cache.get(key)
+    if modified is None:
+        cache.add(key, time.time(), None)
+        modified = cache.get(key, time.time())
+    return modified
+
+
+def invalidate(group):
+    cache.set(get_modified_key(group), time.time(), None)
+
+
+class CachedResponseMixin:
+    """Кэширует ответы list и retrieve вьюсета со справочными данными.
+
+    Ключ включает время последнего изменения группы, поэтому сброс кэша
+    сигналами сводится к записи нового времени. Ответы отдаются с ETag и
+    Last-Modified, на условные GET отвечаем 304.
+    """
+    cache_group = None
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(
+            super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def get_cached_response(self, view, request, *args, **kwargs):
+        modified = get_last_modified(self.cache_group)
+        query = '&'.join(sorted(request.GET.urlencode().split('&')))
+        # Путь и запрос хэшируются: memcached не принимает длинные ключи.
+        url = hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+        key = f'api:{self.cache_group}:{modified}:{self.action}:{url}'
+        entry = cache.get(key)
+        if entry is None:
+            with read_from_primary():
+                response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            content = json.dumps(response.data, sort_keys=True,
+                                 ensure_ascii=False).encode()
+            etag = quote_etag(hashlib.md5(content).hexdigest())
+            entry = (response.data, etag)
+            cache.set(key, entry, settings.API_CACHE_TIMEOUT)
+
+        data, etag = entry
+        last_modified = int(modified)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = Response(data)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tags(**kwargs):
+    invalidate('tags')
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_ingredients(**kwargs):
+    invalidate('ingredients')
@@ -0,0 +1,139 @@
+import csv
+import random
+from contextlib import contextmanager
+from io import StringIO
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+
+from api.autocomplete import ingredient_index
+from api.matching import match_index
+from api.search import search_index
+from recipes.models import (Favourite, Ingredient, Recipe, RecipeIngredients,
+                            ShoppingCart, ShoppingCartIngredient, Tag)
+from users.models import Subscribe, User
+
+
+SEED_DEFAULTS = {
+    'users': 20,
+    'recipes': 300,
+    'ingredients': 0,
+    'ingredients_per_recipe': 8,
+    'favorites': 10,
+    'cart': 5,
+    'subscriptions': 5,
+}
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = round(percent / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def clear_caches():
+    """Сбрасывает кэши Django и индексы процесса.
+
+    Число запросов зависит от того, прогреты ли кэши, поэтому каждый
+    замер начинается с холодного состояния и прогоны сравнимы.
+    """
+    for cache in caches.all():
+        cache.clear()
+    for index in (ingredient_index, match_index, search_index):
+        index.invalidate()
+
+
+@contextmanager
+def benchmark_database(options, keepdb=False):
+    """Тестовая база, наполненная по options, на время бенчмарка."""
+    random.seed(options.get('seed', 42))
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb
+    )
+    try:
+        seed_database({**SEED_DEFAULTS, **options})
+        clear_caches()
+        yield
+    finally:
+        connection.creation.destroy_test_db(
+            old_name, verbosity=0, keepdb=keepdb
+        )
+        teardown_test_environment()
+
+
+def seed_database(options):
+    """Наполняет базу синтетическими пользователями, рецептами и связями."""
+    path = settings.BASE_DIR / 'data' / 'ingredients.csv'
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    if options['ingredients']:
+        rows = rows[:options['ingredients']]
+    Ingredient.objects.bulk_create(
+        [Ingredient(name=name, measurement_unit=unit)
+         for name, unit in rows],
+        ignore_conflicts=True
+    )
+    ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+
+    Tag.objects.bulk_create([
+        Tag(name=f'Тег {i}', color=f'#{i:06X}', slug=f'tag{i}')
+        for i in range(1, 6)
+    ])
+    User.objects.bulk_create([
+        User(username=f'user{i}', email=f'user{i}@example.com',
+             first_name='Имя', last_name='Фамилия')
+        for i in range(options['users'])
+    ])
+    users = list(User.objects.all())
+
+    Recipe.objects.bulk_create([
+        Recipe(
+            name=f'Рецепт {i}',
+            author=random.choice(users),
+            text='Описание рецепта. ' * 20,
+            image='recipes/benchmark.png',
+            cooking_time=random.randint(1, 120),
+        ) for i in range(options['recipes'])
+    ])
+    recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+    tag_ids = list(Tag.objects.values_list('id', flat=True))
+
+    Recipe.tags.through.objects.bulk_create([
+        Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+        for recipe_id in recipe_ids
+        for tag_id in random.sample(tag_ids, 2)
+    ])
+    per_recipe = min(options['ingredients_per_recipe'],
+                     len(ingredient_ids))
+    RecipeIngredients.objects.bulk_create([
+        RecipeIngredients(recipe_id=recipe_id, ingredient_id=ingredient,
+                          amount=random.randint(1, 500))
+        for recipe_id in recipe_ids
+        for ingredient in random.sample(ingredient_ids, per_recipe)
+    ])
+
+    for model, count in ((Favourite, options['favorites']),
+                         (ShoppingCart, options['cart'])):
+        count = min(count, len(recipe_ids))
+        model.objects.bulk_create([
+            model(user=user, recipe_id=recipe_id)
+            for user in users
+            for recipe_id in random.sample(recipe_ids, count)
+        ])
+    Subscribe.objects.bulk_create([
+        Subscribe(user=user, author=author)
+        for user in users
+        for author in random.sample(
+            [other for other in users if other != user],
+            min(options['subscriptions'], len(users) - 1)
+        )
+    ])
+    ShoppingCartIngredient.objects.rebuild()
+    call_command('reconcile_counters', stdout=StringIO())
+    call_command('rebuild_search_index', stdout=StringIO())
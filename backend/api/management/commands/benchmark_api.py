@@ -0,0 +1,313 @@
+import json
+import re
+import time
+import tracemalloc
+from itertools import combinations
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from api.management.benchmark import (benchmark_database, clear_caches,
+                                      percentile)
+from recipes.models import (POPULAR_ORDERING, Ingredient, Recipe,
+                            ShoppingCartIngredient, Tag)
+from users.models import Subscribe, User
+
+
+RECIPE_FILTERS = {
+    'tags': 'tags={tag}',
+    'author': 'author={author}',
+    'is_favorited': 'is_favorited=1',
+    'is_in_shopping_cart': 'is_in_shopping_cart=1',
+}
+
+
+def full_scans(plan):
+    """Таблицы, которые план читает целиком, без индекса."""
+    if connection.vendor == 'postgresql':
+        return set(re.findall(r'Seq Scan on (\w+)', plan))
+    return {
+        table
+        for table, rest in re.findall(r'\bSCAN (?:TABLE )?(\w+)(.*)', plan)
+        if 'USING' not in rest
+    }
+
+
+class Command(BaseCommand):
+    help = ('Наполняет тестовую базу синтетическими данными и замеряет '
+            'количество запросов, задержку и память для эндпоинтов API.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=500)
+        parser.add_argument('--ingredients', type=int, default=0,
+                            help='Сколько ингредиентов загрузить '
+                                 '(0 - весь файл).')
+        parser.add_argument('--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument('--favorites', type=int, default=20,
+                            help='Избранных рецептов на пользователя.')
+        parser.add_argument('--cart', type=int, default=10,
+                            help='Рецептов в корзине на пользователя.')
+        parser.add_argument('--subscriptions', type=int, default=10,
+                            help='Подписок на пользователя.')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Файл для JSON-результатов.')
+        parser.add_argument('--compare',
+                            help='JSON прошлого прогона: упасть, если '
+                                 'количество запросов выросло.')
+        parser.add_argument('--explain', action='store_true',
+                            help='Проверить через EXPLAIN, что горячие '
+                                 'запросы читают таблицы по индексам.')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Не удалять тестовую базу после прогона.')
+
+    def handle(self, *args, **options):
+        with benchmark_database(options, keepdb=options['keepdb']):
+            # Переключатели вызываются чаще, чем разрешают ставки.
+            with override_settings(THROTTLE_RATES={}):
+                results = self.run_scenarios(options['iterations'])
+            if options['explain']:
+                plans, unindexed = self.check_plans()
+
+        report = {
+            'database': connection.vendor,
+            'config': {
+                key: options[key] for key in (
+                    'users', 'recipes', 'ingredients',
+                    'ingredients_per_recipe', 'favorites', 'cart',
+                    'subscriptions', 'iterations', 'seed',
+                )
+            },
+            'results': results,
+        }
+        if options['explain']:
+            report['plans'] = plans
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        failed = [
+            f'{name}: {result["status"]}'
+            for name, result in results.items() if result['status'] >= 500
+        ]
+        if failed:
+            raise CommandError(
+                'Эндпоинты ответили ошибкой:\n' + '\n'.join(failed)
+            )
+        if options['compare']:
+            self.compare(results, options['compare'])
+        if options['explain'] and unindexed:
+            raise CommandError(
+                'Запросы читают таблицы не по индексам:\n'
+                + '\n'.join(unindexed)
+            )
+
+    def get_scenarios(self, user):
+        recipe = Recipe.objects.first()
+        ingredient = Ingredient.objects.first()
+        tag = Tag.objects.first()
+        author = User.objects.exclude(id=user.id).first()
+        params = {'tag': tag.slug, 'author': recipe.author_id}
+
+        scenarios = [
+            ('users-list', 'get', '/api/users/'),
+            ('users-me', 'get', '/api/users/me/'),
+            ('users-detail', 'get', f'/api/users/{author.id}/'),
+            ('users-subscriptions', 'get',
+             '/api/users/subscriptions/?recipes_limit=3'),
+            ('ingredients-list', 'get', '/api/ingredients/'),
+            ('ingredients-search', 'get',
+             f'/api/ingredients/?name={ingredient.name[:2]}'),
+            ('ingredients-detail', 'get',
+             f'/api/ingredients/{ingredient.id}/'),
+            ('tags-list', 'get', '/api/tags/'),
+            ('tags-detail', 'get', f'/api/tags/{tag.id}/'),
+            ('recipes-detail', 'get', f'/api/recipes/{recipe.id}/'),
+            ('recipes-download-shopping-cart', 'get',
+             '/api/recipes/download_shopping_cart/'),
+            ('recipes-list-popular', 'get', '/api/recipes/?ordering=popular'),
+            ('recipes-feed', 'get', '/api/recipes/feed/'),
+            ('recipes-search', 'get', '/api/recipes/?search=рецепт'),
+        ]
+        for size in range(len(RECIPE_FILTERS) + 1):
+            for names in combinations(RECIPE_FILTERS, size):
+                query = '&'.join(
+                    RECIPE_FILTERS[name].format(**params) for name in names
+                )
+                scenarios.append((
+                    'recipes-list' + ''.join(f'[{name}]' for name in names),
+                    'get',
+                    f'/api/recipes/?{query}' if query else '/api/recipes/',
+                ))
+        return scenarios
+
+    def get_toggles(self, user):
+        recipe = Recipe.objects.exclude(
+            favorites__user=user
+        ).exclude(shopping_cart__user=user).first()
+        author = User.objects.exclude(
+            subscribing__user=user
+        ).exclude(id=user.id).first()
+        toggles = []
+        if recipe:
+            toggles += [
+                (f'recipes-{action}', f'/api/recipes/{recipe.id}/{action}/')
+                for action in ('favorite', 'shopping_cart')
+            ]
+        if author:
+            toggles.append(
+                ('users-subscribe', f'/api/users/{author.id}/subscribe/')
+            )
+        return toggles
+
+    def measure(self, client, method, url, trace=False):
+        if trace:
+            tracemalloc.start()
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = getattr(client, method)(url)
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response)
+            else:
+                size = len(response.content)
+            elapsed = time.perf_counter() - start
+        peak = None
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return {
+            'status': response.status_code,
+            'queries': len(ctx.captured_queries),
+            'elapsed_ms': elapsed * 1000,
+            'peak_bytes': peak,
+            'response_bytes': size,
+        }
+
+    def sample(self, client, method, url, iterations):
+        """Первый прогон считает память, остальные - только время.
+
+        Первый прогон идёт с холодными кэшами, поэтому максимум
+        запросов по прогонам не зависит от предыдущих сценариев.
+        """
+        clear_caches()
+        samples = [self.measure(client, method, url, trace=True)]
+        samples += [self.measure(client, method, url)
+                    for _ in range(iterations - 1)]
+        return samples
+
+    def summarize(self, method, url, samples):
+        timings = [sample['elapsed_ms'] for sample in samples[1:]] or [
+            samples[0]['elapsed_ms']
+        ]
+        last = samples[-1]
+        return {
+            'method': method.upper(),
+            'url': url,
+            'status': last['status'],
+            'queries': max(sample['queries'] for sample in samples),
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'mean_ms': round(sum(timings) / len(timings), 3),
+            'peak_alloc_kb': round(samples[0]['peak_bytes'] / 1024, 1),
+            'response_bytes': last['response_bytes'],
+        }
+
+    def run_scenarios(self, iterations):
+        user = User.objects.order_by('id').first()
+        client = APIClient()
+        client.force_authenticate(user)
+        results = {}
+        for name, method, url in self.get_scenarios(user):
+            samples = self.sample(client, method, url, iterations)
+            results[name] = self.summarize(method, url, samples)
+        for name, url in self.get_toggles(user):
+            added, removed = [], []
+            clear_caches()
+            for iteration in range(iterations):
+                trace = iteration == 0
+                added.append(self.measure(client, 'post', url, trace))
+                removed.append(self.measure(client, 'delete', url, trace))
+            results[f'{name}-add'] = self.summarize('post', url, added)
+            results[f'{name}-remove'] = self.summarize(
+                'delete', url, removed
+            )
+        return results
+
+    def get_plan_checks(self, user):
+        """Горячие запросы, таблица, которую каждый должен читать по
+        индексу, и имя индекса, если он объявлен в модели."""
+        recipe = Recipe.objects.first()
+        return [
+            ('recipes-by-author',
+             Recipe.objects.filter(author=recipe.author_id)[:6], Recipe,
+             'recipe_author_id_idx'),
+            ('recipes-by-tag',
+             Recipe.objects.filter(tags__slug='tag1')[:6],
+             Recipe.tags.through, None),
+            ('recipes-popular',
+             Recipe.objects.order_by(*POPULAR_ORDERING)[:6], Recipe,
+             'recipe_popular_idx'),
+            ('subscriptions',
+             User.objects.filter(
+                 subscribing__user=user
+             ).order_by('-subscribing__id')[:6], Subscribe,
+             'subscribe_user_id_idx'),
+            ('subscription-exists',
+             Subscribe.objects.filter(user=user, author=recipe.author_id),
+             Subscribe, None),
+            ('cart-aggregate',
+             user.cart_ingredients.values_list(
+                 'ingredient__name', 'ingredient__measurement_unit', 'amount'
+             ).order_by('ingredient__name'), ShoppingCartIngredient, None),
+        ]
+
+    def check_plans(self):
+        """Снимает планы горячих запросов на наполненной базе.
+
+        В Postgres последовательное сканирование на время проверки
+        выключено: на маленьком наборе данных планировщик выбрал бы его
+        и при наличии индекса, а так Seq Scan в плане значит, что
+        подходящего индекса нет. Сортировка тоже выключена, и для
+        составных индексов проверяется имя: без них планировщик берёт
+        индекс внешнего ключа с сортировкой или обратный проход по
+        первичному ключу, которые Seq Scan не считаются. В SQLite
+        индекс внешнего ключа уже упорядочен по rowid, поэтому там
+        имя не проверяется.
+        """
+        user = User.objects.order_by('id').first()
+        postgresql = connection.vendor == 'postgresql'
+        plans, failed = {}, []
+        with transaction.atomic():
+            if postgresql:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                    cursor.execute('SET LOCAL enable_sort = off')
+            for name, queryset, model, index in self.get_plan_checks(user):
+                plan = queryset.explain()
+                plans[name] = plan.splitlines()
+                if model._meta.db_table in full_scans(plan):
+                    failed.append(f'{name}: {model._meta.db_table}')
+                elif postgresql and index is not None and index not in plan:
+                    failed.append(f'{name}: нет {index}')
+        return plans, failed
+
+    def compare(self, results, path):
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = [
+            f'{name}: {baseline[name]["queries"]} -> {result["queries"]}'
+            for name, result in results.items()
+            if name in baseline
+            and result['queries'] > baseline[name]['queries']
+        ]
+        if regressions:
+            raise CommandError(
+                'Выросло количество запросов:\n' + '\n'.join(regressions)
+            )
+        self.stdout.write('Регрессий по количеству запросов нет.')
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import sys
+import time
+from types import ModuleType
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import include, path
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.async_views import async_read_urls
+from api.management.benchmark import benchmark_database, clear_caches
+from api.shopping_list import FORMATS
+from api.urls import ASYNC_READ_VIEWSETS, router
+from users.models import User
+
+
+URLS = (
+    '/api/recipes/',
+    '/api/tags/',
+    '/api/ingredients/',
+)
+
+
+async def asgi_get(url, headers):
+    """GET через ASGIHandler, как его вызывает сервер: тело ответа
+    собирается из сообщений http.response.body."""
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(b'host', b'testserver'), *headers],
+        'scheme': 'http',
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 0),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await ASGIHandler()(scope, receive, send)
+    status = next(
+        message['status'] for message in messages
+        if message['type'] == 'http.response.start'
+    )
+    body = b''.join(
+        message.get('body', b'') for message in messages
+        if message['type'] == 'http.response.body'
+    )
+    return status, body
+
+
+def build_urlconf(name, async_reads):
+    patterns = router.urls
+    if async_reads:
+        patterns = async_read_urls(patterns, ASYNC_READ_VIEWSETS)
+    module = ModuleType(name)
+    module.urlpatterns = [path('api/', include(patterns))]
+    sys.modules[name] = module
+    return name
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность списков рецептов, тегов и '
+            'ингредиентов под ASGI: sync-вьюхи против async-пути, и '
+            'проверяет выгрузку списка покупок через ASGI.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Запросов на эндпоинт и режим.')
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--recipes', type=int, default=300)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Файл для JSON-результатов.')
+
+    def handle(self, *args, **options):
+        seed = {'users': options['users'], 'recipes': options['recipes'],
+                'seed': options['seed']}
+        with benchmark_database(seed):
+            results = {}
+            for mode, async_reads in (('sync', False), ('async', True)):
+                urlconf = build_urlconf(f'benchmark_{mode}_urls', async_reads)
+                with override_settings(ROOT_URLCONF=urlconf):
+                    results[mode] = {}
+                    for url in URLS:
+                        clear_caches()
+                        results[mode][url] = asyncio.run(
+                            self.run(url, options)
+                        )
+            broken = self.check_downloads()
+
+        output = json.dumps({
+            'database': connection.vendor,
+            'concurrency': options['concurrency'],
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+        if broken:
+            raise CommandError(
+                'Выгрузка под ASGI отличается от WSGI:\n' + '\n'.join(broken)
+            )
+
+    def check_downloads(self):
+        """Сравнивает выгрузку списка покупок под ASGI и через WSGI.
+
+        Django 3.2 под ASGI перебирает потоковое тело в цикле событий,
+        поэтому ошибка там обрывает ответ уже после статуса 200.
+        """
+        user = User.objects.filter(shopping_cart__isnull=False).first()
+        token, _ = Token.objects.get_or_create(user=user)
+        headers = [(b'authorization', f'Token {token.key}'.encode())]
+        client = APIClient()
+        client.force_authenticate(user)
+        broken = []
+        for file_format in FORMATS:
+            url = ('/api/recipes/download_shopping_cart/'
+                   f'?file_format={file_format}')
+            expected = b''.join(client.get(url).streaming_content)
+            try:
+                status, body = asyncio.run(asgi_get(url, headers))
+            except Exception as error:
+                broken.append(f'{file_format}: {error!r}')
+                continue
+            # В PDF есть дата создания, поэтому сравнивается только размер.
+            if status != 200 or (
+                body != expected if file_format != 'pdf'
+                else abs(len(body) - len(expected)) > 64
+            ):
+                broken.append(f'{file_format}: {status}, {len(body)} байт')
+        return broken
+
+    async def run(self, url, options):
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        statuses = []
+
+        async def fetch():
+            async with semaphore:
+                response = await client.get(url)
+                statuses.append(response.status_code)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(fetch() for _ in range(options['requests'])))
+        elapsed = time.perf_counter() - start
+        return {
+            'requests_per_second': round(len(statuses) / elapsed, 1),
+            'errors': sum(status != 200 for status in statuses),
+        }
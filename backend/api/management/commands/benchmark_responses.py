@@ -0,0 +1,107 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api.management.benchmark import (benchmark_database, clear_caches,
+                                      percentile)
+from api.renderers import FastJSONRenderer
+from api.shopping_list import FORMATS
+from foodgram.compression import brotli, compress_brotli
+from users.models import User
+
+
+RENDERERS = {
+    'json': JSONRenderer,
+    'fast': FastJSONRenderer,
+}
+
+
+def measure(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, round(percentile(timings, 50), 3)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает время рендера JSON и размер ответов со сжатием '
+            'для списка рецептов и выгрузки списка покупок.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--recipes', type=int, default=500)
+        parser.add_argument('--cart', type=int, default=50,
+                            help='Рецептов в корзине каждого пользователя.')
+        parser.add_argument('--page-sizes', default='6,50',
+                            help='Размеры страниц списка через запятую.')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Файл для JSON-результатов.')
+
+    def handle(self, *args, **options):
+        seed = {'users': options['users'], 'recipes': options['recipes'],
+                'cart': options['cart'], 'seed': options['seed']}
+        with benchmark_database(seed):
+            client = APIClient()
+            client.force_authenticate(User.objects.first())
+            results = {}
+            for size in options['page_sizes'].split(','):
+                url = f'/api/recipes/?limit={size}'
+                clear_caches()
+                results[url] = self.run_list(client, url, options)
+            for file_format in FORMATS:
+                url = ('/api/recipes/download_shopping_cart/'
+                       f'?file_format={file_format}')
+                clear_caches()
+                results[url] = self.run_download(client, url, options)
+
+        output = json.dumps({
+            'brotli': brotli is not None,
+            'iterations': options['iterations'],
+            'results': results,
+        }, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_list(self, client, url, options):
+        data = client.get(url).data
+        result = {'render_ms': {}}
+        for name, renderer_class in RENDERERS.items():
+            renderer = renderer_class()
+            content, result['render_ms'][name] = measure(
+                lambda: renderer.render(data, 'application/json'),
+                options['iterations']
+            )
+        result.update(self.compress(content, options['iterations']))
+        return result
+
+    def run_download(self, client, url, options):
+        content, generate_ms = measure(
+            lambda: b''.join(client.get(url).streaming_content),
+            options['iterations']
+        )
+        return {
+            'generate_ms': generate_ms,
+            **self.compress(content, options['iterations']),
+        }
+
+    def compress(self, content, iterations):
+        result = {'bytes': {'identity': len(content)}, 'compress_ms': {}}
+        encoders = {'gzip': compress_string}
+        if brotli is not None:
+            encoders['br'] = compress_brotli
+        for name, compress in encoders.items():
+            compressed, result['compress_ms'][name] = measure(
+                lambda: compress(content), iterations
+            )
+            result['bytes'][name] = len(compressed)
+        return result
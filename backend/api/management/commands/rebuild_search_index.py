@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.search import refresh_documents
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает поисковые документы всех рецептов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(recipe_ids), batch_size):
+            refresh_documents(recipe_ids[start:start + batch_size])
+        self.stdout.write(
+            f'Поисковые документы пересобраны: {len(recipe_ids)} рецептов.'
+        )
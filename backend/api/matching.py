@@ -0,0 +1,157 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from recipes.models import Recipe, RecipeIngredients
+
+
+class RecipeMatchIndex:
+    """Обратный индекс «ингредиент -> рецепты» в памяти процесса.
+
+    Для каждого ингредиента хранится отсортированный массив id рецептов,
+    для каждого рецепта - массив id его ингредиентов. Подбор рецептов
+    по продуктам пользователя складывает списки только этих
+    ингредиентов, не трогая таблицу RecipeIngredients. Рецепт
+    обновляется в индексе после коммита изменений, а целиком индекс
+    перестраивается не реже, чем раз в RECIPE_MATCH_INDEX_TTL секунд.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.recipes = {}
+        self.built_at = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.built_at = None
+
+    def is_stale(self):
+        ttl = getattr(settings, 'RECIPE_MATCH_INDEX_TTL', 600)
+        return (self.built_at is None
+                or time.monotonic() - self.built_at > ttl)
+
+    def build(self):
+        recipes = {}
+        rows = RecipeIngredients.objects.values_list(
+            'recipe_id', 'ingredient_id'
+        ).iterator()
+        for recipe_id, ingredient_id in rows:
+            recipes.setdefault(recipe_id, set()).add(ingredient_id)
+
+        postings = {}
+        for recipe_id in sorted(recipes):
+            for ingredient_id in recipes[recipe_id]:
+                postings.setdefault(ingredient_id, array('q')).append(
+                    recipe_id
+                )
+        self.recipes = {
+            recipe_id: array('q', sorted(ingredients))
+            for recipe_id, ingredients in recipes.items()
+        }
+        self.postings = postings
+        self.built_at = time.monotonic()
+
+    def remove(self, recipe_id):
+        for ingredient_id in self.recipes.pop(recipe_id, ()):
+            recipe_ids = self.postings[ingredient_id]
+            del recipe_ids[bisect_left(recipe_ids, recipe_id)]
+            if not recipe_ids:
+                del self.postings[ingredient_id]
+
+    def update(self, recipe_ingredients):
+        """Заменяет ингредиенты рецептов: {recipe_id: [ingredient_id]}."""
+        with self.lock:
+            if self.built_at is None:
+                return
+            for recipe_id, ingredients in recipe_ingredients.items():
+                self.remove(recipe_id)
+                if not ingredients:
+                    continue
+                self.recipes[recipe_id] = array('q', sorted(ingredients))
+                for ingredient_id in ingredients:
+                    insort(
+                        self.postings.setdefault(ingredient_id, array('q')),
+                        recipe_id
+                    )
+
+    def match(self, ingredient_ids, max_missing=None):
+        """Возвращает [(recipe_id, coverage, missing)] по убыванию доли
+        имеющихся ингредиентов; missing - число недостающих."""
+        with self.lock:
+            if self.is_stale():
+                self.build()
+            matched = Counter()
+            for ingredient_id in set(ingredient_ids):
+                matched.update(self.postings.get(ingredient_id, ()))
+            recipes = self.recipes
+            result = []
+            for recipe_id, count in matched.items():
+                required = len(recipes[recipe_id])
+                if max_missing is None or required - count <= max_missing:
+                    result.append(
+                        (recipe_id, count / required, required - count)
+                    )
+        result.sort(key=lambda row: (-row[1], row[2], -row[0]))
+        return result
+
+    def missing(self, recipe_id, ingredient_ids):
+        """Ингредиенты рецепта, которых нет среди ingredient_ids."""
+        ingredient_ids = set(ingredient_ids)
+        return [
+            pk for pk in self.recipes.get(recipe_id, ())
+            if pk not in ingredient_ids
+        ]
+
+
+match_index = RecipeMatchIndex()
+
+pending = threading.local()
+
+
+def refresh_recipes(recipe_ids):
+    recipe_ingredients = {recipe_id: [] for recipe_id in recipe_ids}
+    rows = RecipeIngredients.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'ingredient_id')
+    for recipe_id, ingredient_id in rows:
+        recipe_ingredients[recipe_id].append(ingredient_id)
+    match_index.update(recipe_ingredients)
+
+
+def schedule_refresh(recipe_id):
+    """Обновляет рецепт в индексе после коммита транзакции.
+
+    Ингредиенты рецепта пишутся bulk_create без сигналов, поэтому
+    состояние читается из базы, когда транзакция уже завершена.
+    """
+    if match_index.built_at is None:
+        return
+    if not hasattr(pending, 'recipe_ids'):
+        pending.recipe_ids = set()
+    pending.recipe_ids.add(recipe_id)
+    transaction.on_commit(flush_pending)
+
+
+def flush_pending():
+    recipe_ids, pending.recipe_ids = pending.recipe_ids, set()
+    if recipe_ids:
+        refresh_recipes(recipe_ids)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def refresh_recipe_matches(instance, **kwargs):
+    schedule_refresh(instance.pk)
+
+
+@receiver(post_save, sender=RecipeIngredients)
+@receiver(post_delete, sender=RecipeIngredients)
+def refresh_recipe_ingredients_matches(instance, **kwargs):
+    schedule_refresh(instance.recipe_id)
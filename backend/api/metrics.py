@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.functional import LazyObject
+
+
+logger = logging.getLogger(__name__)
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTERS = (
+    ('requests_total', 'Обработано запросов.'),
+    ('db_queries_total', 'Выполнено SQL-запросов.'),
+    ('db_seconds_total', 'Время выполнения SQL, секунды.'),
+    ('serializer_seconds_total', 'Время сериализации, секунды.'),
+    ('request_seconds_total', 'Время обработки запросов, секунды.'),
+    ('response_bytes_total', 'Размер тел ответов, байты.'),
+    ('query_budget_exceeded_total', 'Запросов сверх бюджета вьюхи.'),
+)
+
+
+class QueryBudgetError(Exception):
+    pass
+
+
+def is_staff(request):
+    """Сотрудник ли автор запроса, если пользователь уже определён.
+
+    Ленивый request.user из AuthenticationMiddleware здесь не
+    вычисляется: в async-пути это был бы запрос к базе в цикле событий.
+    DRF после аутентификации подставляет в запрос готового пользователя.
+    """
+    user = getattr(request, 'user', None)
+    return (user is not None and not isinstance(user, LazyObject)
+            and user.is_staff)
+
+
+class RequestMetrics:
+    """Счётчики одного запроса: SQL, сериализация, размер ответа."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.view = 'unresolved'
+        self.budget = None
+
+    @contextmanager
+    def measure_serializer(self):
+        # Вложенные сериализаторы уже учтены во внешнем.
+        self.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.serializer_depth -= 1
+            if not self.serializer_depth:
+                self.serializer_time += time.perf_counter() - start
+
+
+class MetricsRegistry:
+    """Накопительные счётчики процесса в разрезе вьюх и методов."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def record(self, metrics, method, elapsed, size, exceeded):
+        labels = (metrics.view, method)
+        increments = (
+            1, metrics.queries, metrics.db_time, metrics.serializer_time,
+            elapsed, size, int(exceeded),
+        )
+        with self.lock:
+            values = self.values.setdefault(labels, [0] * len(COUNTERS))
+            for index, increment in enumerate(increments):
+                values[index] += increment
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        for index, (name, description) in enumerate(COUNTERS):
+            lines.append(f'# HELP foodgram_{name} {description}')
+            lines.append(f'# TYPE foodgram_{name} counter')
+            for (view, method), counters in values:
+                lines.append(
+                    f'foodgram_{name}{{view="{view}",method="{method}"}} '
+                    f'{counters[index]:g}'
+                )
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - start
+        metrics.queries += 1
+
+
+@receiver(connection_created)
+def instrument_connection(connection, **kwargs):
+    """Вешает учёт запросов на каждое соединение один раз.
+
+    Текущий запрос ищется через contextvar, который переходит и в
+    потоки sync_to_async, поэтому запросы считаются в любом потоке.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def measure_serializer():
+    """Учитывает время блока как сериализацию текущего запроса."""
+    metrics = current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.measure_serializer():
+        yield
+
+
+class MeasuredSerializerMixin:
+    """Добавляет время to_representation к метрикам текущего запроса."""
+
+    def to_representation(self, instance):
+        with measure_serializer():
+            return super().to_representation(instance)
+
+
+class QueryMetricsMiddleware:
+    """Считает SQL-запросы, время SQL и сериализации, размер ответа.
+
+    Значения отдаются заголовком Server-Timing и копятся для
+    /api/metrics/. Если вьюха превысила бюджет запросов, в лог пишется
+    предупреждение, а с QUERY_BUDGET_RAISE поднимается исключение -
+    так N+1 ловится в тестах и бенчмарке.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Соединения, открытые до загрузки middleware, сигнала не увидят.
+        for connection in connections.all():
+            instrument_connection(connection)
+        if asyncio.iscoroutinefunction(get_response):
+            # Так же, как MiddlewareMixin: обработчик считает нас async.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, metrics, response, start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, metrics, response, start)
+
+    def finish(self, request, metrics, response, start):
+        elapsed = time.perf_counter() - start
+        size = 0 if response.streaming else len(response.content)
+        exceeded = (metrics.budget is not None
+                    and metrics.queries > metrics.budget)
+        registry.record(metrics, request.method, elapsed, size, exceeded)
+        if settings.DEBUG or is_staff(request):
+            response['Server-Timing'] = ', '.join((
+                f'db;dur={metrics.db_time * 1000:.2f};'
+                f'desc="{metrics.queries} queries"',
+                f'serializer;dur={metrics.serializer_time * 1000:.2f}',
+                f'total;dur={elapsed * 1000:.2f}',
+            ))
+
+        if exceeded:
+            message = (f'{metrics.view}: {metrics.queries} SQL-запросов '
+                       f'при бюджете {metrics.budget}')
+            if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+                raise QueryBudgetError(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = current_metrics.get()
+        if metrics is None:
+            return None
+        view_class = getattr(view_func, 'cls', None)
+        if view_class is None:
+            metrics.view = f'{view_func.__module__}.{view_func.__name__}'
+            return None
+        actions = getattr(view_func, 'actions', None) or {}
+        action = actions.get(request.method.lower())
+        metrics.view = view_class.__name__
+        if action:
+            metrics.view += f'.{action}'
+        metrics.budget = getattr(view_class, 'query_budgets', {}).get(action)
+        return None
+
+
+def metrics_view(request):
+    """Счётчики процесса в текстовом формате Prometheus.
+
+    Доступны по токену METRICS_TOKEN или сотрудникам; без токена в
+    настройках остальным доступ закрыт.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = (
+        token and request.headers.get('Authorization') == f'Bearer {token}'
+    )
+    if not authorized and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(
+        registry.render(), content_type=PROMETHEUS_CONTENT_TYPE
+    )
@@ -1,5 +1,47 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class CustomPagination(PageNumberPagination):
     page_size_query_param = "limit"
+
+
+class RecipeCursorPagination(CursorPagination):
+    """Курсор только по неизменному id.
+
+    Ключ (-favorites_count, -id) у ordering=popular меняется между
+    запросами страниц: рецепт, набравший или потерявший избранное,
+    переходит через курсор и пропускается или повторяется. Такая
+    сортировка остаётся на постраничной пагинации.
+    """
+    page_size_query_param = 'limit'
+    ordering = '-id'
+
+
+class SubscriptionCursorPagination(CursorPagination):
+    page_size_query_param = 'limit'
+    ordering = '-subscription_id'
+
+
+class CursorPaginationMixin:
+    """Включает курсорную пагинацию по запросу ?pagination=cursor.
+
+    Курсорная пагинация не считает COUNT(*) и не сканирует OFFSET, а
+    продолжает выборку с ключа последней записи. Без параметра остаётся
+    постраничная пагинация, которую ждёт фронтенд.
+    """
+    cursor_pagination_class = None
+
+    def use_cursor_pagination(self):
+        params = self.request.query_params
+        return (self.cursor_pagination_class is not None
+                and ('cursor' in params
+                     or params.get('pagination') == 'cursor'))
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.use_cursor_pagination():
+                self._paginator = self.cursor_pagination_class()
+            else:
+                return super().paginator
+        return self._paginator
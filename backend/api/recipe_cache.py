@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from api.cache import get_last_modified, invalidate
+from foodgram.db import read_from_primary
+from recipes.models import Ingredient, Recipe, RecipeIngredients, Tag
+from users.models import User
+
+
+CACHE_GROUP = 'recipe_representations'
+# Поля пользователя, которые попадают в представление автора рецепта.
+AUTHOR_FIELDS = frozenset(('email', 'username', 'first_name', 'last_name'))
+
+
+def get_cache_keys(recipe_ids):
+    generation = get_last_modified(CACHE_GROUP)
+    return {
+        recipe_id: f'recipe_representation:{generation}:{recipe_id}'
+        for recipe_id in recipe_ids
+    }
+
+
+def get_representations(recipes, build):
+    """Общая для всех пользователей часть представления рецептов.
+
+    Готовые словари берутся из кэша одним get_many, отсутствующие
+    строит build(recipes) и они сохраняются в кэш. Для кэша рецепты
+    читаются с основной базы: реплика может отставать. Внутри транзакции
+    построенное не кэшируется: после отката в кэше остались бы
+    незакоммиченные данные.
+    """
+    if not recipes:
+        return {}
+    keys = get_cache_keys(recipe.id for recipe in recipes)
+    cached = cache.get_many(keys.values())
+    representations = {
+        recipe_id: cached[key]
+        for recipe_id, key in keys.items() if key in cached
+    }
+    missing = [
+        recipe for recipe in recipes if recipe.id not in representations
+    ]
+    if missing:
+        with read_from_primary() as switched:
+            if switched:
+                missing = list(Recipe.objects.filter(
+                    id__in=[recipe.id for recipe in missing]
+                ).select_related('author'))
+            built = build(missing)
+        representations.update(built)
+        if not transaction.get_connection().in_atomic_block:
+            cache.set_many(
+                {keys[recipe_id]: data for recipe_id, data in built.items()},
+                settings.RECIPE_REPRESENTATION_TIMEOUT
+            )
+    # Рецепт, уже удалённый в основной базе, собирается без кэша.
+    deleted = [
+        recipe for recipe in recipes if recipe.id not in representations
+    ]
+    if deleted:
+        representations.update(build(deleted))
+    return representations
+
+
+def invalidate_recipes(recipe_ids):
+    """Сбрасывает представления рецептов сразу и после коммита.
+
+    Повторный сброс после коммита убирает то, что параллельный запрос
+    успел закэшировать по старым данным, пока шла транзакция.
+    """
+    keys = list(get_cache_keys(recipe_ids).values())
+    if not keys:
+        return
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_all():
+    invalidate(CACHE_GROUP)
+    transaction.on_commit(lambda: invalidate(CACHE_GROUP))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_recipe(instance, **kwargs):
+    invalidate_recipes([instance.pk])
+
+
+@receiver(post_save, sender=RecipeIngredients)
+@receiver(post_delete, sender=RecipeIngredients)
+def invalidate_recipe_ingredients(instance, **kwargs):
+    invalidate_recipes([instance.recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags(instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_recipes([instance.pk])
+    elif pk_set:
+        invalidate_recipes(pk_set)
+    else:
+        invalidate_all()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_dictionaries(created=False, **kwargs):
+    # Новый тег или ингредиент ещё не входит ни в один рецепт.
+    if not created:
+        invalidate_all()
+
+
+@receiver(post_save, sender=User)
+def invalidate_author(instance, created, update_fields, **kwargs):
+    if created or (update_fields is not None
+                   and not AUTHOR_FIELDS.intersection(update_fields)):
+        return
+    invalidate_recipes(
+        Recipe.objects.filter(author=instance).values_list('id', flat=True)
+    )
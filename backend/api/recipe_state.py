@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from foodgram.db import read_from_primary
+from recipes.models import Favourite, ShoppingCart
+
+
+def get_cache_key(model, user_id):
+    return f'recipe_state:{model._meta.model_name}:{user_id}'
+
+
+def refresh_recipe_ids(model, user_id):
+    with read_from_primary():
+        ids = frozenset(model.objects.filter(
+            user_id=user_id
+        ).values_list('recipe_id', flat=True))
+    cache.set(get_cache_key(model, user_id), ids,
+              settings.RECIPE_STATE_TIMEOUT)
+    return ids
+
+
+def get_recipe_ids(model, user):
+    """Id рецептов пользователя в избранном или в корзине.
+
+    Множество хранится в кэше и сбрасывается после каждого изменения
+    Favourite или ShoppingCart, так что сериализатор и фильтры получают
+    флаги без запросов к базе, а после изменения - одним запросом.
+    """
+    if user.is_anonymous:
+        return frozenset()
+    ids = cache.get(get_cache_key(model, user.id))
+    if ids is None:
+        ids = refresh_recipe_ids(model, user.id)
+    return ids
+
+
+def invalidate_recipe_ids(model, user_id):
+    """Сбрасывает множество после коммита, его перечитает следующий запрос.
+
+    Нужен там, где Favourite и ShoppingCart меняются без сигналов
+    моделей, как в CountedLinkQuerySet на PostgreSQL.
+    """
+    transaction.on_commit(
+        lambda: cache.delete(get_cache_key(model, user_id))
+    )
+
+
+@receiver(post_save, sender=Favourite)
+@receiver(post_delete, sender=Favourite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_delete, sender=ShoppingCart)
+def update_recipe_ids(sender, instance, **kwargs):
+    invalidate_recipe_ids(sender, instance.user_id)
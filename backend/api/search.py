@@ -0,0 +1,311 @@
+import operator
+import re
+import threading
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections, transaction
+from django.db.models import (Case, FloatField, IntegerField, OuterRef,
+                              Subquery, When)
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api.cache import get_last_modified, invalidate
+from recipes.models import (Ingredient, Recipe, RecipeIngredients,
+                            RecipeSearchDocument)
+from recipes.tasks import run_on_commit, task
+
+
+SEARCH_CONFIG = 'russian'
+
+# Веса полей как у setweight() в Postgres: A - название, B - ингредиенты,
+# C - описание. Значения совпадают с весами ts_rank по умолчанию.
+FIELD_WEIGHTS = (
+    ('name', 'A', 1.0),
+    ('ingredients', 'B', 0.4),
+    ('text', 'C', 0.2),
+)
+
+# Поля рецепта, из которых собирается документ.
+DOCUMENT_FIELDS = frozenset(('name', 'text'))
+
+SEARCH_INDEX_NAME = 'recipes_search_vector_gin'
+SEARCH_CACHE_GROUP = 'search_documents'
+
+VOWELS = 'аеиоуыэюя'
+
+PERFECTIVE_GERUND = re.compile(
+    r'(?:(?<=[ая])(?:в|вши|вшись)|ив|ивши|ившись|ыв|ывши|ывшись)$'
+)
+REFLEXIVE = re.compile(r'с[яь]$')
+ADJECTIVE = (
+    r'(?:ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|'
+    r'их|ых|ую|юю|ая|яя|ою|ею)'
+)
+PARTICIPLE = r'(?:(?<=[ая])(?:ем|нн|вш|ющ|щ)|ивш|ывш|ующ)'
+ADJECTIVAL = re.compile(f'{PARTICIPLE}?{ADJECTIVE}$')
+VERB = re.compile(
+    r'(?:(?<=[ая])(?:ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)|'
+    r'ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|'
+    r'ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)$'
+)
+NOUN = re.compile(
+    r'(?:а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|'
+    r'ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+)
+DERIVATIONAL = re.compile(r'ость?$')
+SUPERLATIVE = re.compile(r'ейше?$')
+
+WORD = re.compile(r'\w+')
+
+STOP_WORDS = frozenset((
+    'а', 'без', 'в', 'во', 'да', 'для', 'до', 'же', 'за', 'и', 'из', 'или',
+    'к', 'ко', 'на', 'над', 'не', 'но', 'о', 'об', 'от', 'по', 'под', 'при',
+    'с', 'со', 'то', 'у',
+))
+
+
+def region_after_vowel_consonant(word, start):
+    for index in range(start + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            return index + 1
+    return len(word)
+
+
+def stem(word):
+    """Русский стеммер Snowball, тот же алгоритм, что в словаре russian."""
+    word = word.lower().replace('ё', 'е')
+    rv = next(
+        (index + 1 for index, char in enumerate(word) if char in VOWELS),
+        len(word)
+    )
+    r2 = region_after_vowel_consonant(
+        word, region_after_vowel_consonant(word, 0)
+    )
+    prefix, ending = word[:rv], word[rv:]
+    r2 = max(r2 - rv, 0)
+
+    match = PERFECTIVE_GERUND.search(ending)
+    if match:
+        ending = ending[:match.start()]
+    else:
+        ending = REFLEXIVE.sub('', ending)
+        for pattern in (ADJECTIVAL, VERB, NOUN):
+            match = pattern.search(ending)
+            if match:
+                ending = ending[:match.start()]
+                break
+
+    if ending.endswith('и'):
+        ending = ending[:-1]
+
+    match = DERIVATIONAL.search(ending)
+    if match and match.start() >= r2:
+        ending = ending[:match.start()]
+
+    match = SUPERLATIVE.search(ending)
+    if match:
+        ending = ending[:match.start()]
+    if ending.endswith('нн'):
+        ending = ending[:-1]
+    elif ending.endswith('ь'):
+        ending = ending[:-1]
+    return prefix + ending
+
+
+def analyze(text):
+    for word in WORD.findall(text.lower()):
+        if word not in STOP_WORDS:
+            yield stem(word)
+
+
+class RecipeSearchIndex:
+    """Обратный индекс рецептов в памяти процесса.
+
+    Используется, когда база не Postgres. Для каждого терма хранятся
+    веса рецептов, в которых он встречается. Индекс собран для поколения
+    группы search_documents в общем кэше. Его сдвигают пересборка
+    документов в воркере и удаление рецепта, и каждый процесс
+    перестраивает индекс при следующем поиске.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.built_for = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.built_for = None
+
+    def build(self, modified):
+        self.postings = {}
+        rows = RecipeSearchDocument.objects.values_list(
+            'recipe_id', *(field for field, _, _ in FIELD_WEIGHTS)
+        ).iterator()
+        for recipe_id, *values in rows:
+            self.add(recipe_id, values)
+        self.built_for = modified
+
+    def add(self, recipe_id, values):
+        terms = {}
+        for value, (_, _, weight) in zip(values, FIELD_WEIGHTS):
+            for term in analyze(value):
+                terms[term] = terms.get(term, 0) + weight
+        for term, score in terms.items():
+            self.postings.setdefault(term, {})[recipe_id] = score
+
+    def search(self, query, limit=None):
+        terms = set(analyze(query))
+        if not terms:
+            return []
+        modified = get_last_modified(SEARCH_CACHE_GROUP)
+        with self.lock:
+            if self.built_for != modified:
+                self.build(modified)
+            postings = sorted(
+                (self.postings.get(term, {}) for term in terms), key=len
+            )
+            found = set(postings[0]).intersection(*postings[1:])
+            ranked = sorted(
+                found,
+                key=lambda pk: (-sum(scores[pk] for scores in postings), -pk)
+            )
+        return ranked if limit is None else ranked[:limit]
+
+
+def invalidate_search_index():
+    """Сдвигает поколение индекса для всех процессов после коммита."""
+    transaction.on_commit(lambda: invalidate(SEARCH_CACHE_GROUP))
+
+
+search_index = RecipeSearchIndex()
+
+
+def build_documents(recipes):
+    return [
+        RecipeSearchDocument(
+            recipe=recipe,
+            name=recipe.name,
+            ingredients=' '.join(
+                item.ingredient.name for item in recipe.ingredient_list.all()
+            ),
+            text=recipe.text,
+        )
+        for recipe in recipes
+    ]
+
+
+@task
+def refresh_documents(recipe_ids):
+    """Пересобирает поисковые документы указанных рецептов."""
+    recipe_ids = set(recipe_ids)
+    recipes = Recipe.objects.filter(id__in=recipe_ids).prefetch_related(
+        'ingredient_list__ingredient'
+    )
+    documents = build_documents(recipes)
+    with transaction.atomic():
+        RecipeSearchDocument.objects.filter(recipe_id__in=recipe_ids).delete()
+        RecipeSearchDocument.objects.bulk_create(documents)
+    invalidate_search_index()
+
+
+def schedule_refresh(recipe_ids):
+    """Обновляет документы фоновой задачей после коммита транзакции.
+
+    Рецепт и его ингредиенты пишутся в одной транзакции, поэтому
+    документ собирается, когда все строки уже сохранены. Ключ задачи
+    схлопывает повторные изменения одного рецепта.
+    """
+    for recipe_id in set(recipe_ids):
+        run_on_commit(
+            refresh_documents, [recipe_id], key=f'search:{recipe_id}'
+        )
+
+
+def get_search_vector():
+    """Взвешенный tsvector документа, как setweight() по полям."""
+    return reduce(operator.add, (
+        SearchVector(field, weight=label, config=SEARCH_CONFIG)
+        for field, label, _ in FIELD_WEIGHTS
+    ))
+
+
+def search_recipes(queryset, query):
+    """Оставляет рецепты, подходящие под запрос, по убыванию релевантности."""
+    if connections[queryset.db].vendor == 'postgresql':
+        # Выражения ссылаются на колонки, а не на имя таблицы, поэтому
+        # остаются верными и во вложенных запросах с алиасом U0.
+        vector = get_search_vector()
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        documents = RecipeSearchDocument.objects.using(
+            queryset.db
+        ).annotate(vector=vector).filter(vector=search_query)
+        rank = documents.filter(recipe=OuterRef('pk')).annotate(
+            rank=SearchRank(vector, search_query)
+        ).values('rank')
+        return queryset.filter(
+            id__in=documents.values('recipe_id')
+        ).annotate(
+            search_rank=Subquery(rank, output_field=FloatField())
+        ).order_by('-search_rank', '-id')
+
+    limit = getattr(settings, 'SEARCH_RESULTS_LIMIT', 1000)
+    recipe_ids = search_index.search(query, limit)
+    return queryset.filter(id__in=recipe_ids).order_by(Case(
+        *(When(id=pk, then=position)
+          for position, pk in enumerate(recipe_ids)),
+        output_field=IntegerField()
+    ))
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_recipe_document(instance, update_fields, **kwargs):
+    if (update_fields is not None
+            and not DOCUMENT_FIELDS.intersection(update_fields)):
+        return
+    schedule_refresh((instance.pk,))
+
+
+@receiver(post_save, sender=RecipeIngredients)
+@receiver(post_delete, sender=RecipeIngredients)
+def refresh_recipe_ingredients_document(instance, **kwargs):
+    schedule_refresh((instance.recipe_id,))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_recipe_document(instance, **kwargs):
+    invalidate_search_index()
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_ingredient_documents(instance, created, **kwargs):
+    if not created:
+        schedule_refresh(RecipeIngredients.objects.filter(
+            ingredient=instance
+        ).values_list('recipe_id', flat=True))
+
+
+def create_search_index(using, **kwargs):
+    """Создаёт GIN-индекс по взвешенному tsvector документа в Postgres.
+
+    Индекс функциональный и строится из того же get_search_vector(), по
+    которому фильтрует search_recipes, поэтому планировщик его
+    использует. В Meta модели его не объявить: миграции recipes
+    создаются makemigrations при развёртывании и на SQLite упали бы на
+    GIN и to_tsvector. Подключается к post_migrate только для recipes.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    table = RecipeSearchDocument._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    if SEARCH_INDEX_NAME in constraints:
+        return
+    with connection.schema_editor() as schema_editor:
+        schema_editor.add_index(RecipeSearchDocument, GinIndex(
+            get_search_vector(), name=SEARCH_INDEX_NAME
+        ))
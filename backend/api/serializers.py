@@ -1,19 +1,28 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import transaction
-from django.db.models import F
-from django.shortcuts import get_object_or_404
+from django.db.models import F, Manager, prefetch_related_objects
 from djoser.serializers import UserSerializer
 from drf_extra_fields.fields import Base64ImageField
-from rest_framework import status
-from rest_framework.exceptions import ValidationError
-from rest_framework.fields import IntegerField, SerializerMethodField
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.fields import (CharField, Field, FloatField,
+                                   IntegerField, ListField,
+                                   SerializerMethodField)
 from rest_framework.relations import PrimaryKeyRelatedField
-from rest_framework.serializers import ModelSerializer
-
-from recipes.models import Ingredient, Recipe, RecipeIngredients, Tag
+from rest_framework.serializers import (ListSerializer, ModelSerializer,
+                                        Serializer)
+
+from api.metrics import MeasuredSerializerMixin, measure_serializer
+from api.recipe_cache import get_representations
+from recipes.feed import schedule_fan_out
+from recipes.images import VARIANTS, schedule_variants
+from recipes.models import (Ingredient, Recipe, RecipeIngredients,
+                            ShoppingCartIngredient, Tag,
+                            get_recipe_prefetches)
 from users.models import Subscribe, User
 
 
-class CustomUserSerializer(UserSerializer):
+class CustomUserSerializer(MeasuredSerializerMixin, UserSerializer):
     is_subscribed = SerializerMethodField(read_only=True)
 
     class Meta:
@@ -28,6 +37,8 @@ class CustomUserSerializer(UserSerializer):
         )
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context.get('request').user
         return (user.is_authenticated
                 and bool(Subscribe.objects.filter(user=user, author=obj)))
@@ -43,25 +54,13 @@ class SubscribeSerializer(CustomUserSerializer):
         )
         read_only_fields = ('email', 'username')
 
-    def validate(self, data):
-        author = self.instance
-        user = self.context.get('request').user
-        if Subscribe.objects.filter(author=author, user=user).exists():
-            raise ValidationError(
-                detail='Вы уже подписаны на этого пользователя!',
-                code=status.HTTP_400_BAD_REQUEST
-            )
-        if user == author:
-            raise ValidationError(
-                detail='Вы не можете подписаться на самого себя!',
-                code=status.HTTP_400_BAD_REQUEST
-            )
-        return data
-
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
     def get_recipes(self, obj):
+        if 'recipes_by_author' in self.context:
+            recipes = self.context['recipes_by_author'][obj.id]
+            return RecipeShortSerializer(recipes, many=True).data
         request = self.context.get('request')
         limit = request.GET.get('recipes_limit')
         recipes = obj.recipes.all()
@@ -71,25 +70,80 @@ class SubscribeSerializer(CustomUserSerializer):
         return serializer.data
 
 
-class IngredientSerializer(ModelSerializer):
+class IngredientSerializer(MeasuredSerializerMixin, ModelSerializer):
     class Meta:
         model = Ingredient
         fields = '__all__'
 
 
-class TagSerializer(ModelSerializer):
+class TagSerializer(MeasuredSerializerMixin, ModelSerializer):
     class Meta:
         model = Tag
         fields = '__all__'
 
 
-class RecipeReadSerializer(ModelSerializer):
+class ImageVariantsField(Field):
+    """Ссылки на уменьшенные копии изображения рецепта.
+
+    Пока фоновая обработка не закончилась, вместо копий отдаётся
+    оригинал.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def build_url(self, path):
+        url = default_storage.url(path)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def to_representation(self, recipe):
+        if not recipe.image:
+            return None
+        variants = recipe.image_variants or {}
+        original = {'original': self.build_url(recipe.image.name)}
+        return {
+            name: {
+                key: self.build_url(path)
+                for key, path in variants[name].items()
+            } if name in variants else original
+            for name in VARIANTS
+        }
+
+
+class RecipeIngredientReadSerializer(ModelSerializer):
+    id = IntegerField(source='ingredient.id')
+    name = CharField(source='ingredient.name')
+    measurement_unit = CharField(source='ingredient.measurement_unit')
+
+    class Meta:
+        model = RecipeIngredients
+        fields = ('id', 'name', 'measurement_unit', 'amount')
+
+
+class RecipeAuthorSerializer(CustomUserSerializer):
+    class Meta(CustomUserSerializer.Meta):
+        fields = tuple(
+            name for name in CustomUserSerializer.Meta.fields
+            if name != 'is_subscribed'
+        )
+
+
+class RecipeSharedSerializer(ModelSerializer):
+    """Часть рецепта, одинаковая для всех пользователей.
+
+    Сериализуется без запроса в контексте, поэтому ссылки на файлы
+    получаются относительными и подходят для любого хоста.
+    """
     tags = TagSerializer(many=True, read_only=True)
-    author = CustomUserSerializer(read_only=True)
-    ingredients = SerializerMethodField()
+    author = RecipeAuthorSerializer(read_only=True)
+    ingredients = RecipeIngredientReadSerializer(
+        source='ingredient_list', many=True, read_only=True
+    )
     image = Base64ImageField()
-    is_favorited = SerializerMethodField(read_only=True)
-    is_in_shopping_cart = SerializerMethodField(read_only=True)
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
@@ -98,34 +152,124 @@ class RecipeReadSerializer(ModelSerializer):
             'tags',
             'author',
             'ingredients',
-            'is_favorited',
-            'is_in_shopping_cart',
             'name',
             'image',
+            'image_variants',
             'text',
             'cooking_time',
         )
 
-    def get_ingredients(self, obj):
-        recipe = obj
-        ingredients = recipe.ingredients.values(
+
+class RecipeListSerializer(ListSerializer):
+
+    def to_representation(self, data):
+        recipes = data.all() if isinstance(data, Manager) else data
+        return self.child.to_representations(list(recipes))
+
+
+class RecipeReadSerializer(RecipeSharedSerializer):
+    """Рецепт для чтения: закэшированная общая часть и флаги.
+
+    Общая часть строится RecipeSharedSerializer только для рецептов,
+    которых нет в кэше, и только для них загружаются теги и
+    ингредиенты. К ней добавляются флаги текущего пользователя и
+    абсолютные ссылки на файлы.
+    """
+    author = CustomUserSerializer(read_only=True)
+    is_favorited = SerializerMethodField(read_only=True)
+    is_in_shopping_cart = SerializerMethodField(read_only=True)
+
+    class Meta(RecipeSharedSerializer.Meta):
+        fields = (
             'id',
+            'tags',
+            'author',
+            'ingredients',
+            'is_favorited',
+            'is_in_shopping_cart',
             'name',
-            'measurement_unit',
-            amount=F('recipeingredients__amount')
+            'image',
+            'image_variants',
+            'text',
+            'cooking_time',
         )
-        return ingredients
+        list_serializer_class = RecipeListSerializer
 
     def get_is_favorited(self, obj):
+        if 'favorited_ids' in self.context:
+            return obj.id in self.context['favorited_ids']
         user = self.context.get('request').user
         return (user.is_authenticated
                 and user.favorites.filter(recipe=obj).exists())
 
     def get_is_in_shopping_cart(self, obj):
+        if 'in_shopping_cart_ids' in self.context:
+            return obj.id in self.context['in_shopping_cart_ids']
         user = self.context.get('request').user
         return (user.is_authenticated
                 and user.shopping_cart.filter(recipe=obj).exists())
 
+    def get_is_author_subscribed(self, recipe):
+        if hasattr(recipe, 'is_author_subscribed'):
+            return recipe.is_author_subscribed
+        user = self.context.get('request').user
+        return (user.is_authenticated
+                and Subscribe.objects.filter(
+                    user=user, author_id=recipe.author_id
+                ).exists())
+
+    def build_shared(self, recipes):
+        prefetch_related_objects(recipes, *get_recipe_prefetches())
+        serializer = RecipeSharedSerializer()
+        return {
+            recipe.id: serializer.to_representation(recipe)
+            for recipe in recipes
+        }
+
+    def to_representation(self, instance):
+        return self.to_representations([instance])[0]
+
+    def to_representations(self, recipes):
+        with measure_serializer():
+            return self.merge_representations(
+                recipes, get_representations(recipes, self.build_shared)
+            )
+
+    def merge_representations(self, recipes, shared):
+        request = self.context.get('request')
+        host = request.build_absolute_uri('/')[:-1] if request else ''
+
+        def absolute(url):
+            if url.startswith('/') and not url.startswith('//'):
+                return host + url
+            return url
+
+        results = []
+        for recipe in recipes:
+            data = shared[recipe.id]
+            flags = {
+                'is_favorited': self.get_is_favorited(recipe),
+                'is_in_shopping_cart': self.get_is_in_shopping_cart(recipe),
+            }
+            representation = {
+                name: flags[name] if name in flags else data[name]
+                for name in self.Meta.fields
+            }
+            if data['author'] is not None:
+                representation['author'] = {
+                    **data['author'],
+                    'is_subscribed': self.get_is_author_subscribed(recipe)
+                }
+            if data['image'] is not None:
+                representation['image'] = absolute(data['image'])
+            if data['image_variants'] is not None:
+                representation['image_variants'] = {
+                    name: {key: absolute(url) for key, url in urls.items()}
+                    for name, urls in data['image_variants'].items()
+                }
+            results.append(representation)
+        return results
+
 
 class IngredientInRecipeWriteSerializer(ModelSerializer):
     id = IntegerField(write_only=True)
@@ -135,7 +279,7 @@ class IngredientInRecipeWriteSerializer(ModelSerializer):
         fields = ('id', 'amount')
 
 
-class RecipeWriteSerializer(ModelSerializer):
+class RecipeWriteSerializer(MeasuredSerializerMixin, ModelSerializer):
     tags = PrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True)
     author = CustomUserSerializer(read_only=True)
     ingredients = IngredientInRecipeWriteSerializer(many=True)
@@ -159,73 +303,114 @@ class RecipeWriteSerializer(ModelSerializer):
             raise ValidationError({
                 'ingredients': 'Нужен хотя бы один ингредиент!'
             })
-        ingredients_list = []
-        for item in value:
-            ingredient = get_object_or_404(Ingredient, id=item['id'])
-            if ingredient in ingredients_list:
-                raise ValidationError({
-                    'ingredients': 'Ингридиенты не могут повторяться!'
-                })
-            if int(item['amount']) <= 0:
-                raise ValidationError({
-                    'amount': 'Количество ингредиента должно быть больше 0!'
-                })
-            ingredients_list.append(ingredient)
+        ids = [item['id'] for item in value]
+        if len(set(ids)) != len(ids):
+            raise ValidationError({
+                'ingredients': 'Ингридиенты не могут повторяться!'
+            })
+        if any(int(item['amount']) <= 0 for item in value):
+            raise ValidationError({
+                'amount': 'Количество ингредиента должно быть больше 0!'
+            })
+        if len(Ingredient.objects.in_bulk(ids)) != len(ids):
+            raise NotFound('Ингредиент не найден.')
         return value
 
     def validate_tags(self, value):
         if not value:
             raise ValidationError({'tags': 'Нужно выбрать хотя бы один тег!'})
-        tags_list = []
-        for tag in value:
-            if tag in tags_list:
-                raise ValidationError({
-                    'tags': 'Теги должны быть уникальными!'
-                })
-            tags_list.append(tag)
+        if len(set(value)) != len(value):
+            raise ValidationError({
+                'tags': 'Теги должны быть уникальными!'
+            })
         return value
 
     @transaction.atomic
     def create_ingredients_amounts(self, ingredients, recipe):
         RecipeIngredients.objects.bulk_create(
             [RecipeIngredients(
-                ingredient=Ingredient.objects.get(id=ingredient['id']),
+                ingredient_id=ingredient['id'],
                 recipe=recipe,
                 amount=ingredient['amount']
             ) for ingredient in ingredients]
         )
 
+    def update_ingredients_amounts(self, ingredients, recipe):
+        """Меняет только добавленные, удалённые и изменённые строки.
+
+        Возвращает True, если состав рецепта изменился.
+        """
+        current = {
+            row.ingredient_id: row for row in recipe.ingredient_list.all()
+        }
+        amounts = {item['id']: item['amount'] for item in ingredients}
+        removed = current.keys() - amounts.keys()
+        changed = []
+        for ingredient_id, row in current.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and row.amount != amount:
+                row.amount = amount
+                changed.append(row)
+        added = [
+            item for item in ingredients if item['id'] not in current
+        ]
+        if removed:
+            RecipeIngredients.objects.filter(
+                recipe=recipe, ingredient_id__in=removed
+            ).delete()
+        if changed:
+            RecipeIngredients.objects.bulk_update(changed, ['amount'])
+        if added:
+            self.create_ingredients_amounts(ingredients=added, recipe=recipe)
+        return bool(removed or changed or added)
+
     @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
         recipe = Recipe.objects.create(**validated_data)
-        recipe.tags.set(tags)
+        User.objects.filter(id=recipe.author_id).update(
+            recipes_count=F('recipes_count') + 1
+        )
+        recipe.tags.add(*tags)
         self.create_ingredients_amounts(recipe=recipe,
                                         ingredients=ingredients)
+        schedule_variants(recipe)
+        schedule_fan_out(recipe)
         return recipe
 
     @transaction.atomic
     def update(self, instance, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
+        stale_variants = None
+        if 'image' in validated_data:
+            # Копии прежнего изображения не отдаются рядом с новым: до
+            # конца обработки ImageVariantsField отдаёт оригинал.
+            stale_variants = instance.image_variants
+            validated_data['image_variants'] = {}
         instance = super().update(instance, validated_data)
-        instance.tags.clear()
         instance.tags.set(tags)
-        instance.ingredients.clear()
-        self.create_ingredients_amounts(recipe=instance,
-                                        ingredients=ingredients)
-        instance.save()
+        if self.update_ingredients_amounts(recipe=instance,
+                                           ingredients=ingredients):
+            ShoppingCartIngredient.objects.rebuild(
+                instance.shopping_cart.values_list('user', flat=True)
+            )
+        if stale_variants is not None:
+            schedule_variants(instance, stale_variants)
         return instance
 
     def to_representation(self, instance):
-        request = self.context.get('request')
-        context = {'request': request}
-        return RecipeReadSerializer(instance, context=context).data
+        user = self.context.get('request').user
+        instance = Recipe.objects.select_related(
+            'author'
+        ).with_author_subscription(user).get(pk=instance.pk)
+        return RecipeReadSerializer(instance, context=self.context).data
 
 
-class RecipeShortSerializer(ModelSerializer):
+class RecipeShortSerializer(MeasuredSerializerMixin, ModelSerializer):
     image = Base64ImageField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
@@ -233,5 +418,29 @@ class RecipeShortSerializer(ModelSerializer):
             'id',
             'name',
             'image',
+            'image_variants',
             'cooking_time'
         )
+
+
+class RecipeMatchSerializer(RecipeShortSerializer):
+    coverage = FloatField(read_only=True)
+    missing_ingredients = IngredientSerializer(many=True, read_only=True)
+
+    class Meta(RecipeShortSerializer.Meta):
+        fields = RecipeShortSerializer.Meta.fields + (
+            'coverage',
+            'missing_ingredients'
+        )
+
+
+class BulkIdsSerializer(Serializer):
+    """Список id для массовых операций, повторы отбрасываются."""
+    ids = ListField(
+        child=IntegerField(min_value=1),
+        min_length=1,
+        max_length=settings.BULK_MAX_IDS
+    )
+
+    def validate_ids(self, value):
+        return list(dict.fromkeys(value))
@@ -0,0 +1,137 @@
+import csv
+import json
+from datetime import datetime
+from io import BytesIO
+from itertools import groupby
+
+from django.conf import settings
+
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+except ImportError:
+    canvas = None
+
+
+CHUNK_SIZE = 500
+
+# Единицы, которые приводятся к базовой: (базовая единица, множитель).
+UNIT_CONVERSIONS = {
+    'кг': ('г', 1000),
+    'мг': ('г', 0.001),
+    'л': ('мл', 1000),
+}
+
+
+def normalize(unit, amount):
+    base_unit, factor = UNIT_CONVERSIONS.get(unit, (unit, 1))
+    return base_unit, amount * factor
+
+
+def format_amount(amount):
+    if float(amount).is_integer():
+        return str(int(amount))
+    return f'{amount:.3f}'.rstrip('0').rstrip('.')
+
+
+def aggregate_ingredients(user):
+    """Суммирует ингредиенты корзины, приводя единицы к базовым.
+
+    Суммы по рецептам уже посчитаны в ShoppingCartIngredient. Строки
+    читаются курсором, отсортированными по названию, поэтому одинаковые
+    ингредиенты идут подряд и группируются без словаря на всю корзину.
+    """
+    rows = user.cart_ingredients.values_list(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        'amount'
+    ).order_by('ingredient__name').iterator(chunk_size=CHUNK_SIZE)
+
+    for name, group in groupby(rows, key=lambda row: row[0]):
+        totals = {}
+        for _, unit, amount in group:
+            base_unit, amount = normalize(unit, amount)
+            totals[base_unit] = totals.get(base_unit, 0) + amount
+        for unit, amount in totals.items():
+            yield name, unit, amount
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def render_txt(user, ingredients):
+    today = datetime.today()
+    yield (
+        f'Список покупок для: {user.get_full_name()}\n\n'
+        f'Дата: {today:%Y-%m-%d}\n\n'
+    )
+    for name, unit, amount in ingredients:
+        yield f'- {name} ({unit}) - {format_amount(amount)}\n'
+    yield f'\nFoodgram ({today:%Y})'
+
+
+def render_csv(user, ingredients):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Ингредиент', 'Единица измерения', 'Количество'))
+    for name, unit, amount in ingredients:
+        yield writer.writerow((name, unit, format_amount(amount)))
+
+
+def render_json(user, ingredients):
+    yield '{"user": %s, "date": "%s", "ingredients": [' % (
+        json.dumps(user.get_full_name(), ensure_ascii=False),
+        f'{datetime.today():%Y-%m-%d}'
+    )
+    separator = ''
+    for name, unit, amount in ingredients:
+        yield separator + json.dumps({
+            'name': name,
+            'measurement_unit': unit,
+            'amount': float(amount) if amount % 1 else int(amount),
+        }, ensure_ascii=False)
+        separator = ', '
+    yield ']}'
+
+
+def render_pdf(user, ingredients):
+    font = 'Helvetica'
+    font_path = getattr(settings, 'SHOPPING_LIST_PDF_FONT', None)
+    if font_path:
+        pdfmetrics.registerFont(TTFont('ShoppingListFont', font_path))
+        font = 'ShoppingListFont'
+
+    buffer = BytesIO()
+    document = canvas.Canvas(buffer, pagesize=A4)
+    _, height = A4
+    top, bottom, step = height - 50, 50, 18
+    y = top
+    document.setFont(font, 14)
+    document.drawString(50, y, f'Список покупок для: {user.get_full_name()}')
+    y -= step * 2
+    document.setFont(font, 11)
+    for name, unit, amount in ingredients:
+        if y < bottom:
+            document.showPage()
+            document.setFont(font, 11)
+            y = top
+        document.drawString(
+            50, y, f'- {name} ({unit}) - {format_amount(amount)}'
+        )
+        y -= step
+    document.save()
+    yield buffer.getvalue()
+
+
+FORMATS = {
+    'txt': ('text/plain; charset=utf-8', render_txt),
+    'csv': ('text/csv; charset=utf-8', render_csv),
+    'json': ('application/json', render_json),
+}
+if canvas is not None:
+    FORMATS['pdf'] = ('application/pdf', render_pdf)
@@ -0,0 +1,106 @@
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.throttling import BaseThrottle
+
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+# Счётчики процесса на случай, когда общий кэш недоступен.
+fallback_counters = LocMemCache('throttle', {})
+
+
+def parse_rate(rate):
+    """'30/min' -> (30, 60): запросов за период и период в секундах."""
+    number, period = rate.split('/')
+    return int(number), PERIODS[period[0]]
+
+
+def count_request(counters, key, limit, period):
+    """Учитывает запрос, возвращает 0 или сколько ждать, секунды.
+
+    Скользящее окно: запросы текущего окна длиной period считаются
+    атомарным incr, а счётчик прошлого окна входит с весом ещё не
+    истёкшей его доли, поэтому лимит не обнуляется на границе окна.
+    add и incr атомарны в memcached и LocMem: одновременные запросы
+    получают разные значения счётчика и не проходят сверх limit.
+    Отклонённый запрос возвращается из счётчика через decr.
+    """
+    now = time.time()
+    window, elapsed = divmod(now / period, 1)
+    current = f'{key}:{int(window)}'
+    timeout = math.ceil(period * 2)
+    counters.add(current, 0, timeout)
+    try:
+        count = counters.incr(current)
+    except ValueError:
+        # Счётчик истёк между add и incr.
+        counters.add(current, 0, timeout)
+        count = counters.incr(current)
+    previous = counters.get(f'{key}:{int(window) - 1}', 0)
+    if previous * (1 - elapsed) + count <= limit:
+        return 0
+    counters.decr(current)
+    if count <= limit:
+        # Хватит подождать, пока вес прошлого окна уменьшится.
+        return (1 - (limit - count) / previous - elapsed) * period
+    return (1 - elapsed) * period
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """Лимит запросов для действия вьюсета, ставки из THROTTLE_RATES.
+
+    Ставки задаются для view.action отдельно по пользователю и по
+    IP-адресу, kind подкласса выбирает, по чему считать. Адрес берётся
+    get_ident из X-Forwarded-For с учётом NUM_PROXIES: nginx дописывает
+    туда адрес клиента, и доверяется только последней записи. Счётчики
+    лежат в кэше THROTTLE_CACHE, который должен быть общим для всех
+    воркеров (memcached); если кэш недоступен, используются счётчики
+    процесса.
+    """
+    kind = None
+
+    def get_ident_key(self, request):
+        if self.kind == 'ip':
+            return self.get_ident(request)
+        if request.user.is_authenticated:
+            return request.user.pk
+        return None
+
+    def allow_request(self, request, view):
+        self.delay = 0
+        rate = settings.THROTTLE_RATES.get(view.action, {}).get(self.kind)
+        if rate is None:
+            return True
+        ident = self.get_ident_key(request)
+        if ident is None:
+            return True
+        limit, period = parse_rate(rate)
+        key = f'throttle:{view.action}:{self.kind}:{ident}'
+        try:
+            self.delay = count_request(
+                caches[settings.THROTTLE_CACHE], key, limit, period
+            )
+        except Exception:
+            logger.warning('Кэш для throttling недоступен', exc_info=True)
+            self.delay = count_request(
+                fallback_counters, key, limit, period
+            )
+        return not self.delay
+
+    def wait(self):
+        return self.delay
+
+
+class UserSlidingWindowThrottle(SlidingWindowThrottle):
+    kind = 'user'
+
+
+class IPSlidingWindowThrottle(SlidingWindowThrottle):
+    kind = 'ip'
@@ -1,6 +1,9 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework import routers
 
+from api.async_views import async_read_urls
+from api.metrics import metrics_view
 from api.views import (CustomUserViewSet, IngredientViewSet, RecipeViewSet,
                        TagViewSet)
 
@@ -11,8 +14,15 @@ router.register('ingredients', IngredientViewSet)
 router.register('tags', TagViewSet)
 router.register('recipes', RecipeViewSet)
 
+ASYNC_READ_VIEWSETS = (RecipeViewSet, TagViewSet, IngredientViewSet)
+
+router_urls = router.urls
+if settings.ASYNC_READ_VIEWS:
+    router_urls = async_read_urls(router_urls, ASYNC_READ_VIEWSETS)
+
 urlpatterns = [
-    path('', include(router.urls)),
+    path('metrics/', metrics_view, name='metrics'),
+    path('', include(router_urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
 ]
@@ -1,112 +1,348 @@
-from datetime import datetime
-
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import BooleanField, F, Value
+from django.db.models.functions import Greatest
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.status import HTTP_400_BAD_REQUEST
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from api.filters import IngredientFilter, RecipeFilter
-from api.pagination import CustomPagination
+from api.autocomplete import ingredient_index
+from api.cache import CachedResponseMixin
+from api.filters import RecipeFilter
+from api.matching import match_index
+from api.pagination import (CursorPaginationMixin, CustomPagination,
+                            RecipeCursorPagination,
+                            SubscriptionCursorPagination)
 from api.permissions import AdminOrReadOnly, AuthorOrReadOnly
-from api.serializers import (CustomUserSerializer, IngredientSerializer,
+from api.recipe_state import get_recipe_ids, invalidate_recipe_ids
+from api.serializers import (BulkIdsSerializer, CustomUserSerializer,
+                             IngredientSerializer, RecipeMatchSerializer,
                              RecipeReadSerializer, RecipeShortSerializer,
                              RecipeWriteSerializer, SubscribeSerializer,
                              TagSerializer)
-from recipes.models import (Favourite, Ingredient, Recipe, RecipeIngredients,
-                            ShoppingCart, Tag)
+from api.shopping_list import FORMATS, aggregate_ingredients
+from api.throttling import (IPSlidingWindowThrottle,
+                            UserSlidingWindowThrottle)
+from recipes.images import delete_variants
+from recipes.models import (Favourite, FeedEntry, Ingredient, Recipe,
+                            ShoppingCart, ShoppingCartIngredient, Tag)
 from users.models import Subscribe, User
 
 
-class CustomUserViewSet(UserViewSet):
+TOGGLE_THROTTLES = (UserSlidingWindowThrottle, IPSlidingWindowThrottle)
+
+
+def get_object_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise Http404
+
+
+def get_bulk_ids(request):
+    serializer = BulkIdsSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data['ids']
+
+
+def get_added_outcomes(model, ids, added):
+    """Итог добавления по каждому id: added, exists или not_found."""
+    added_ids = {obj.id for obj in added}
+    outcomes = dict.fromkeys(ids, 'not_found')
+    rest = [pk for pk in ids if pk not in added_ids]
+    if rest:
+        outcomes.update(dict.fromkeys(
+            model.objects.filter(id__in=rest).values_list('id', flat=True),
+            'exists'
+        ))
+    outcomes.update(dict.fromkeys(added_ids, 'added'))
+    return outcomes
+
+
+def get_removed_outcomes(ids, removed):
+    """Итог удаления по каждому id: removed или not_found."""
+    outcomes = dict.fromkeys(ids, 'not_found')
+    outcomes.update(dict.fromkeys((obj.id for obj in removed), 'removed'))
+    return outcomes
+
+
+def get_bulk_response(outcomes):
+    return Response({'results': [
+        {'id': pk, 'status': outcome} for pk, outcome in outcomes.items()
+    ]})
+
+
+class CustomUserViewSet(CursorPaginationMixin, UserViewSet):
     queryset = User.objects.all()
     serializer_class = CustomUserSerializer
+    query_budgets = {'subscriptions': 6}
+
+    def get_throttles(self):
+        # DELETE на /subscriptions/ отображён на тот же маршрут, что и
+        # список, и берёт его throttle_classes; лимит нужен только ему.
+        if self.action == 'clear_subscriptions':
+            return [throttle() for throttle in TOGGLE_THROTTLES]
+        return super().get_throttles()
 
     @action(
         detail=True,
         methods=('post', 'delete'),
-        permission_classes=(IsAuthenticated,)
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES
     )
+    @transaction.atomic
     def subscribe(self, request, **kwargs):
         user = request.user
-        author_id = self.kwargs.get('id')
-        author = get_object_or_404(User, id=author_id)
+        author_id = get_object_id(self.kwargs.get('id'))
 
         if request.method == 'POST':
+            if author_id == user.id:
+                raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+                    'Вы не можете подписаться на самого себя!'
+                ]})
+            author = Subscribe.objects.add(user, author_id)
+            if author is None:
+                get_object_or_404(User, id=author_id)
+                raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+                    'Вы уже подписаны на этого пользователя!'
+                ]})
+            FeedEntry.objects.follow(user, [author])
+            author.is_subscribed = True
             serializer = SubscribeSerializer(
-                author,
-                data=request.data,
-                context={"request": request}
+                author, context={'request': request}
             )
-            serializer.is_valid(raise_exception=True)
-            Subscribe.objects.create(user=user, author=author)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        subscription = get_object_or_404(
-            Subscribe,
-            user=user,
-            author=author
-        )
-        subscription.delete()
+        author = Subscribe.objects.remove(user, author_id)
+        if author is None:
+            raise Http404
+        FeedEntry.objects.unfollow(user, [author])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
         detail=False,
-        permission_classes=(IsAuthenticated,)
+        methods=('post', 'delete'),
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES,
+        url_path='subscribe/bulk'
+    )
+    @transaction.atomic
+    def subscribe_bulk(self, request):
+        """Подписка на авторов из списка ids или отписка от них."""
+        user = request.user
+        ids = get_bulk_ids(request)
+        if request.method == 'DELETE':
+            authors = Subscribe.objects.remove_many(user, ids)
+            if authors:
+                FeedEntry.objects.unfollow(user, authors)
+            return get_bulk_response(get_removed_outcomes(ids, authors))
+
+        authors = Subscribe.objects.add_many(
+            user, [pk for pk in ids if pk != user.id]
+        )
+        if authors:
+            FeedEntry.objects.follow(user, authors)
+        outcomes = get_added_outcomes(User, ids, authors)
+        if user.id in outcomes:
+            outcomes[user.id] = 'self'
+        return get_bulk_response(outcomes)
+
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+        cursor_pagination_class=SubscriptionCursorPagination
     )
     def subscriptions(self, request):
         user = request.user
-        queryset = User.objects.filter(subscribing__user=user)
+        queryset = User.objects.filter(subscribing__user=user).annotate(
+            subscription_id=F('subscribing__id'),
+            is_subscribed=Value(True, output_field=BooleanField()),
+        )
         pages = self.paginate_queryset(queryset)
+        limit = request.query_params.get('recipes_limit')
+        recipes = Recipe.objects.latest_by_author(
+            [author.id for author in pages],
+            int(limit) if limit and limit.isdigit() else None
+        )
         serializer = SubscribeSerializer(
             pages,
             many=True,
-            context={'request': request}
+            context={'request': request, 'recipes_by_author': recipes}
         )
         return self.get_paginated_response(serializer.data)
 
+    @subscriptions.mapping.delete
+    @transaction.atomic
+    def clear_subscriptions(self, request):
+        authors = Subscribe.objects.remove_many(request.user)
+        if authors:
+            FeedEntry.objects.unfollow(request.user, authors)
+        return get_bulk_response(get_removed_outcomes((), authors))
+
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(CachedResponseMixin, ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (AdminOrReadOnly,)
-    filter_backends = (DjangoFilterBackend,)
-    filterset_class = IngredientFilter
     pagination_class = None
+    cache_group = 'ingredients'
+    use_read_replica = True
+    query_budgets = {'list': 2, 'retrieve': 2}
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return super().list(request, *args, **kwargs)
+        limit = request.query_params.get('limit')
+        if limit and limit.isdigit():
+            limit = int(limit)
+        else:
+            limit = settings.INGREDIENT_AUTOCOMPLETE_LIMIT
+        return Response(ingredient_index.search(name, limit))
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(CachedResponseMixin, ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (AdminOrReadOnly,)
     pagination_class = None
+    cache_group = 'tags'
+    use_read_replica = True
+    query_budgets = {'list': 2, 'retrieve': 2}
 
 
-class RecipeViewSet(ModelViewSet):
+class RecipeViewSet(CursorPaginationMixin, ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = (AuthorOrReadOnly | AdminOrReadOnly,)
     pagination_class = CustomPagination
+    cursor_pagination_class = RecipeCursorPagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
+    # С запасом на промах кэша избранного и корзины.
+    query_budgets = {'list': 8, 'retrieve': 6, 'feed': 7, 'match': 5}
+    use_read_replica = True
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve', 'feed'):
+            # Теги и ингредиенты RecipeReadSerializer загрузит сам только
+            # для рецептов, которых нет в кэше представлений.
+            queryset = queryset.select_related(
+                'author'
+            ).with_author_subscription(self.request.user)
+        return queryset
+
+    def use_cursor_pagination(self):
+        return (self.request.query_params.get('ordering') != 'popular'
+                and super().use_cursor_pagination())
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        user = self.request.user
+        context['favorited_ids'] = get_recipe_ids(Favourite, user)
+        context['in_shopping_cart_ids'] = get_recipe_ids(ShoppingCart, user)
+        return context
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        users = list(instance.shopping_cart.values_list('user', flat=True))
+        variants = instance.image_variants
+        instance.delete()
+        User.objects.filter(id=instance.author_id).update(
+            recipes_count=Greatest(F('recipes_count') - 1, 0)
+        )
+        ShoppingCartIngredient.objects.rebuild(users)
+        transaction.on_commit(lambda: delete_variants(variants))
+
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
             return RecipeReadSerializer
         return RecipeWriteSerializer
 
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+        pagination_class=RecipeCursorPagination
+    )
+    def feed(self, request):
+        queryset = self.filter_queryset(
+            self.get_queryset().feed(request.user)
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=False,
+        pagination_class=CustomPagination,
+        cursor_pagination_class=None
+    )
+    def match(self, request):
+        """Рецепты, которые можно приготовить из указанных ингредиентов."""
+        params = request.query_params
+        try:
+            ingredient_ids = {
+                int(pk)
+                for value in params.getlist('ingredients')
+                for pk in value.split(',') if pk
+            }
+            max_missing = params.get('max_missing')
+            if max_missing is not None:
+                max_missing = int(max_missing)
+        except ValueError:
+            return Response(
+                {'errors': 'Параметры должны быть целыми числами.'},
+                status=HTTP_400_BAD_REQUEST
+            )
+        if not ingredient_ids:
+            return Response({'errors': 'Укажите ингредиенты.'},
+                            status=HTTP_400_BAD_REQUEST)
+
+        page = self.paginate_queryset(
+            match_index.match(ingredient_ids, max_missing)
+        )
+        recipes = Recipe.objects.in_bulk([row[0] for row in page])
+        missing_ids = {
+            recipe_id: match_index.missing(recipe_id, ingredient_ids)
+            for recipe_id, _, _ in page
+        }
+        ingredients = Ingredient.objects.in_bulk(
+            {pk for pks in missing_ids.values() for pk in pks}
+        )
+        results = []
+        for recipe_id, coverage, _ in page:
+            recipe = recipes.get(recipe_id)
+            if recipe is None:
+                continue
+            recipe.coverage = coverage
+            recipe.missing_ingredients = [
+                ingredients[pk] for pk in missing_ids[recipe_id]
+                if pk in ingredients
+            ]
+            results.append(recipe)
+        serializer = RecipeMatchSerializer(
+            results, many=True, context={'request': request}
+        )
+        return self.get_paginated_response(serializer.data)
+
     @action(
         detail=True,
         methods=('post', 'delete'),
-        permission_classes=(IsAuthenticated,)
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES
     )
     def favorite(self, request, pk):
         if request.method == 'POST':
@@ -116,29 +352,103 @@ class RecipeViewSet(ModelViewSet):
     @action(
         detail=True,
         methods=('post', 'delete'),
-        permission_classes=(IsAuthenticated,)
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES
     )
     def shopping_cart(self, request, pk):
         if request.method == 'POST':
             return self.add_to(ShoppingCart, request.user, pk)
         return self.delete_from(ShoppingCart, request.user, pk)
 
+    @action(
+        detail=False,
+        methods=('post', 'delete'),
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES,
+        url_path='favorite/bulk'
+    )
+    def favorite_bulk(self, request):
+        return self.change_many(Favourite, request)
+
+    @action(
+        detail=False,
+        methods=('delete',),
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES,
+        url_path='favorite'
+    )
+    def clear_favorite(self, request):
+        return self.clear(Favourite, request.user)
+
+    @action(
+        detail=False,
+        methods=('post', 'delete'),
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES,
+        url_path='shopping_cart/bulk'
+    )
+    def shopping_cart_bulk(self, request):
+        return self.change_many(ShoppingCart, request)
+
+    @action(
+        detail=False,
+        methods=('delete',),
+        permission_classes=(IsAuthenticated,),
+        throttle_classes=TOGGLE_THROTTLES,
+        url_path='shopping_cart'
+    )
+    def clear_shopping_cart(self, request):
+        return self.clear(ShoppingCart, request.user)
+
+    def after_change(self, model, user, recipes, added):
+        """Обновляет состояние, которое зависит от избранного и корзины."""
+        if not recipes:
+            return
+        invalidate_recipe_ids(model, user.id)
+        if model is ShoppingCart:
+            if added:
+                ShoppingCartIngredient.objects.add_recipes(user, recipes)
+            else:
+                ShoppingCartIngredient.objects.remove_recipes(user, recipes)
+
+    @transaction.atomic
     def add_to(self, model, user, pk):
-        if model.objects.filter(user=user, recipe__id=pk).exists():
+        recipe = model.objects.add(user, get_object_id(pk))
+        if recipe is None:
+            get_object_or_404(Recipe, id=pk)
             return Response({'errors': 'Рецепт уже добавлен!'},
                             status=status.HTTP_400_BAD_REQUEST)
-        recipe = get_object_or_404(Recipe, id=pk)
-        model.objects.create(user=user, recipe=recipe)
+        self.after_change(model, user, [recipe], added=True)
         serializer = RecipeShortSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @transaction.atomic
     def delete_from(self, model, user, pk):
-        obj = model.objects.filter(user=user, recipe__id=pk)
-        if obj.exists():
-            obj.delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        return Response({'errors': 'Рецепт уже удален!'},
-                        status=status.HTTP_400_BAD_REQUEST)
+        recipe = model.objects.remove(user, get_object_id(pk))
+        if recipe is None:
+            return Response({'errors': 'Рецепт уже удален!'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        self.after_change(model, user, [recipe], added=False)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @transaction.atomic
+    def change_many(self, model, request):
+        """Добавляет рецепты из списка ids или удаляет их."""
+        user = request.user
+        ids = get_bulk_ids(request)
+        if request.method == 'DELETE':
+            recipes = model.objects.remove_many(user, ids)
+            self.after_change(model, user, recipes, added=False)
+            return get_bulk_response(get_removed_outcomes(ids, recipes))
+        recipes = model.objects.add_many(user, ids)
+        self.after_change(model, user, recipes, added=True)
+        return get_bulk_response(get_added_outcomes(Recipe, ids, recipes))
+
+    @transaction.atomic
+    def clear(self, model, user):
+        recipes = model.objects.remove_many(user)
+        self.after_change(model, user, recipes, added=False)
+        return get_bulk_response(get_removed_outcomes((), recipes))
 
     @action(
         detail=False,
@@ -149,28 +459,24 @@ class RecipeViewSet(ModelViewSet):
         if not user.shopping_cart.exists():
             return Response(status=HTTP_400_BAD_REQUEST)
 
-        ingredients = RecipeIngredients.objects.filter(
-            recipe__shopping_cart__user=request.user
-        ).values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(cart_amount=Sum('amount'))
-
-        today = datetime.today()
-        shopping_list = (
-            f'Список покупок для: {user.get_full_name()}\n\n'
-            f'Дата: {today:%Y-%m-%d}\n\n'
+        file_format = request.query_params.get('file_format', 'txt')
+        if file_format not in FORMATS:
+            return Response(
+                {'errors': 'Доступные форматы: ' + ', '.join(FORMATS)},
+                status=HTTP_400_BAD_REQUEST
+            )
+        content_type, render = FORMATS[file_format]
+
+        ingredients = aggregate_ingredients(user)
+        if isinstance(request._request, ASGIRequest):
+            # Под ASGI Django 3.2 перебирает тело потокового ответа в цикле
+            # событий, где ORM недоступен, поэтому строки читаются здесь.
+            # Под WSGI они читаются курсором по ходу отдачи.
+            ingredients = list(ingredients)
+        response = StreamingHttpResponse(
+            render(user, ingredients), content_type=content_type
         )
-        shopping_list += '\n'.join([
-            f'- {ingredient["ingredient__name"]} '
-            f'({ingredient["ingredient__measurement_unit"]})'
-            f' - {ingredient["cart_amount"]}'
-            for ingredient in ingredients
-        ])
-        shopping_list += f'\n\nFoodgram ({today:%Y})'
-
-        filename = f'{user.username}_shopping_list.txt'
-        response = HttpResponse(shopping_list, content_type='text/plain')
+        filename = f'{user.username}_shopping_list.{file_format}'
         response['Content-Disposition'] = f'attachment; filename={filename}'
 
         return response
@@ -0,0 +1,129 @@
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODING_RE = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?')
+
+
+def get_encoding_weights(header):
+    """Веса кодировок из заголовка Accept-Encoding."""
+    weights = {}
+    for item in header.lower().split(','):
+        match = ENCODING_RE.match(item)
+        if match is None:
+            continue
+        coding, quality = match.groups()
+        try:
+            weights[coding] = 1.0 if quality is None else float(quality)
+        except ValueError:
+            continue
+    return weights
+
+
+def choose_encoding(header):
+    weights = get_encoding_weights(header)
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def join_chunks(sequence, size):
+    """Склеивает мелкие куски потока: сжатие по строке почти не сжимает."""
+    buffer = []
+    length = 0
+    for item in sequence:
+        buffer.append(item)
+        length += len(item)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def compress_brotli(content):
+    return brotli.compress(
+        content, mode=brotli.MODE_TEXT,
+        quality=settings.COMPRESSION_BROTLI_QUALITY
+    )
+
+
+def compress_brotli_sequence(sequence):
+    compressor = brotli.Compressor(
+        mode=brotli.MODE_TEXT, quality=settings.COMPRESSION_BROTLI_QUALITY
+    )
+    for item in sequence:
+        # Отдаём каждый кусок сразу, как compress_sequence для gzip.
+        data = compressor.process(item) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Сжимает текстовые ответы в brotli или gzip по Accept-Encoding.
+
+    Brotli используется, если установлен пакет brotli. Обычные ответы
+    меньше COMPRESSION_MIN_SIZE байт не сжимаются: выигрыш не окупает
+    время на сжатие. Потоковые ответы (список покупок) сжимаются
+    всегда, если тип содержимого из COMPRESSION_CONTENT_TYPES; PDF и
+    изображения уже сжаты и отдаются как есть.
+    """
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return response
+        content_type = response.get('Content-Type', '').split(';')[0]
+        if content_type not in settings.COMPRESSION_CONTENT_TYPES:
+            return response
+        if (not response.streaming
+                and len(response.content) < settings.COMPRESSION_MIN_SIZE):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(
+            request.META.get('HTTP_ACCEPT_ENCODING', '')
+        )
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            compress = (
+                compress_brotli_sequence if encoding == 'br'
+                else compress_sequence
+            )
+            response.streaming_content = compress(join_chunks(
+                response.streaming_content,
+                settings.COMPRESSION_STREAM_CHUNK_SIZE
+            ))
+            del response['Content-Length']
+        else:
+            compress = (
+                compress_brotli if encoding == 'br' else compress_string
+            )
+            compressed = compress(response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(response.content))
+
+        # Сжатый ответ побайтно отличается от исходного, поэтому сильный
+        # ETag становится слабым, как в GZipMiddleware.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connections, models, router
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+from rest_framework.permissions import SAFE_METHODS
+
+
+REPLICA = 'replica'
+
+# Таблицы, которые читаются сразу после записи в другом запросе: токен
+# выдаётся при входе и тут же используется, поэтому они всегда
+# читаются с основной базы.
+PRIMARY_ONLY_APPS = frozenset(('authtoken', 'sessions', 'contenttypes'))
+
+current_routing = ContextVar('current_routing', default=None)
+
+
+class RoutingState:
+    read_replica = False
+
+
+class ReadReplicaRouter:
+    """Отправляет чтение на реплику, если его разрешил middleware.
+
+    Запись и всё, что выполняется вне запроса (команды, фоновые
+    задачи), идёт в основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = current_routing.get()
+        if (state is not None and state.read_replica
+                and model._meta.app_label not in PRIMARY_ONLY_APPS):
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != REPLICA
+
+
+@contextmanager
+def read_from_primary():
+    """Чтение внутри блока идёт в основную базу, даже если запрос читает
+    с реплики. Отдаёт True, если маршрут действительно переключён.
+
+    Так наполняются долгоживущие кэши: строка с отстающей реплики,
+    попавшая в кэш после сброса, пережила бы окно отставания на часы.
+    """
+    state = current_routing.get()
+    if state is None or not state.read_replica:
+        yield False
+        return
+    state.read_replica = False
+    try:
+        yield True
+    finally:
+        state.read_replica = True
+
+
+def get_client_key(request):
+    """Ключ клиента для привязки к основной базе после записи."""
+    credentials = (
+        request.headers.get('Authorization')
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    )
+    if not credentials:
+        return None
+    digest = hashlib.sha256(credentials.encode()).hexdigest()
+    return f'db:primary:{digest}'
+
+
+class ReplicaRoutingMiddleware:
+    """Читает с реплики безопасные запросы вьюсетов с use_read_replica.
+
+    После успешной записи клиент на DB_REPLICA_PIN_SECONDS секунд
+    привязывается к основной базе, чтобы видеть свои изменения, пока
+    реплика догоняет. Привязка хранится в кэше, поэтому при нескольких
+    воркерах нужен общий CACHE_BACKEND.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = REPLICA in settings.DATABASES
+        if asyncio.iscoroutinefunction(get_response):
+            # Так же, как MiddlewareMixin: обработчик считает нас async.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = current_routing.set(RoutingState())
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        self.pin_after_write(request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = current_routing.set(RoutingState())
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        self.pin_after_write(request, response)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = current_routing.get()
+        view_class = getattr(view_func, 'cls', None)
+        if (not self.enabled or state is None
+                or request.method not in SAFE_METHODS
+                or not getattr(view_class, 'use_read_replica', False)):
+            return None
+        key = get_client_key(request)
+        state.read_replica = key is None or cache.get(key) is None
+        return None
+
+    def pin_after_write(self, request, response):
+        if (not self.enabled or request.method in SAFE_METHODS
+                or response.status_code >= 400):
+            return
+        key = get_client_key(request)
+        if key is not None:
+            cache.set(key, 1, settings.DB_REPLICA_PIN_SECONDS)
+
+
+def close_unusable_connections():
+    """Проверяет постоянные соединения перед запросом.
+
+    Соединение, которое сервер или pgbouncer закрыл между запросами,
+    закрывается и будет открыто заново при первом обращении. Проверка
+    стоит лишнего SELECT 1, поэтому соединение проверяется не чаще раза
+    в DB_CONN_HEALTH_CHECK_INTERVAL секунд.
+    """
+    if not settings.DB_CONN_HEALTH_CHECKS:
+        return
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or (
+            now - getattr(connection, 'health_checked_at', 0)
+            < settings.DB_CONN_HEALTH_CHECK_INTERVAL
+        ):
+            continue
+        connection.health_checked_at = now
+        if not connection.is_usable():
+            connection.close()
+
+
+@receiver(connection_created)
+def mark_connection_checked(connection, **kwargs):
+    connection.health_checked_at = time.monotonic()
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    close_unusable_connections()
+
+
+class CountedLinkQuerySet(models.QuerySet):
+    """Связи «пользователь - объект» со счётчиком связей на объекте.
+
+    На PostgreSQL добавление и удаление связей вместе с изменением
+    счётчиков - один запрос: INSERT ... ON CONFLICT DO NOTHING или
+    DELETE в CTE и UPDATE ... RETURNING по его результату, без
+    предварительной проверки exists() и без ошибки при конфликте
+    уникального ограничения. На других базах то же делается одним
+    bulk_create(ignore_conflicts=True) или DELETE ... IN и обновлением
+    счётчиков.
+
+    Модель связи задаёт counter_field - поле счётчика на объекте.
+    """
+    owner_field = 'user'
+    target_field = None
+
+    def get_target_model(self):
+        return self.model._meta.get_field(self.target_field).related_model
+
+    def add(self, owner, target_id):
+        """Добавляет связь, возвращает объект с новым счётчиком.
+
+        Если связь уже есть или объекта нет, возвращает None.
+        """
+        added = self.add_many(owner, [target_id])
+        return added[0] if added else None
+
+    def remove(self, owner, target_id):
+        """Удаляет связь, возвращает объект или None, если связи не было."""
+        removed = self.remove_many(owner, [target_id])
+        return removed[0] if removed else None
+
+    def add_many(self, owner, target_ids):
+        """Добавляет связи, возвращает объекты, для которых их не было."""
+        db = router.db_for_write(self.model)
+        if connections[db].vendor != 'postgresql':
+            return self.add_with_orm(db, owner, target_ids)
+        return self.execute_returning(db, (
+            'WITH changed AS ('
+            'INSERT INTO {link} ({owner}, {target}) '
+            'SELECT %s, {pk} FROM {table} WHERE {pk} = ANY(%s) '
+            'ON CONFLICT DO NOTHING RETURNING {target}) '
+            'UPDATE {table} SET {counter} = {counter} + 1 '
+            'WHERE {pk} IN (SELECT {target} FROM changed) '
+            'RETURNING {columns}'
+        ), [owner.pk, list(target_ids)])
+
+    def remove_many(self, owner, target_ids=None):
+        """Удаляет связи владельца (все, если target_ids не задан).
+
+        Возвращает объекты, связи с которыми были удалены.
+        """
+        db = router.db_for_write(self.model)
+        if connections[db].vendor != 'postgresql':
+            return self.remove_with_orm(db, owner, target_ids)
+        condition, params = '', [owner.pk]
+        if target_ids is not None:
+            condition = ' AND {target} = ANY(%s)'
+            params.append(list(target_ids))
+        return self.execute_returning(db, (
+            'WITH changed AS ('
+            'DELETE FROM {link} WHERE {owner} = %s' + condition + ' '
+            'RETURNING {target}) '
+            'UPDATE {table} SET {counter} = GREATEST({counter} - 1, 0) '
+            'WHERE {pk} IN (SELECT {target} FROM changed) '
+            'RETURNING {columns}'
+        ), params)
+
+    def execute_returning(self, db, sql, params):
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        link = self.model._meta
+        target = self.get_target_model()._meta
+        fields = target.concrete_fields
+        sql = sql.format(
+            link=quote(link.db_table),
+            owner=quote(link.get_field(self.owner_field).column),
+            target=quote(link.get_field(self.target_field).column),
+            table=quote(target.db_table),
+            pk=quote(target.pk.column),
+            counter=quote(target.get_field(self.model.counter_field).column),
+            columns=', '.join(quote(field.column) for field in fields),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        objects = []
+        for row in rows:
+            # Сырой курсор не применяет from_db_value, например у JSONField.
+            values = []
+            for field, value in zip(fields, row):
+                for converter in field.get_db_converters(connection):
+                    value = converter(value, field, connection)
+                values.append(value)
+            objects.append(target.model.from_db(
+                db, [field.attname for field in fields], values
+            ))
+        return objects
+
+    def add_with_orm(self, db, owner, target_ids):
+        targets = self.get_target_model()._default_manager.using(db)
+        existing = self.using(db).filter(**{
+            self.owner_field: owner, f'{self.target_field}__in': target_ids
+        }).values_list(self.target_field, flat=True)
+        added = list(
+            targets.filter(pk__in=target_ids).exclude(pk__in=existing)
+        )
+        self.using(db).bulk_create(
+            [self.model(**{self.owner_field: owner, self.target_field: target})
+             for target in added],
+            ignore_conflicts=True
+        )
+        counter = self.model.counter_field
+        targets.filter(pk__in=[target.pk for target in added]).update(
+            **{counter: F(counter) + 1}
+        )
+        for target in added:
+            setattr(target, counter, getattr(target, counter) + 1)
+        return added
+
+    def remove_with_orm(self, db, owner, target_ids):
+        links = self.using(db).filter(**{self.owner_field: owner})
+        if target_ids is not None:
+            links = links.filter(**{f'{self.target_field}__in': target_ids})
+        removed = list(links.values_list(self.target_field, flat=True))
+        if not removed:
+            return []
+        links.filter(**{f'{self.target_field}__in': removed}).delete()
+        counter = self.model.counter_field
+        targets = self.get_target_model()._default_manager.using(db)
+        targets.filter(pk__in=removed).update(
+            **{counter: Greatest(F(counter) - 1, 0)}
+        )
+        return list(targets.filter(pk__in=removed))
@@ -29,11 +29,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.QueryMetricsMiddleware',
+    'foodgram.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'foodgram.db.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -62,15 +65,53 @@ WSGI_APPLICATION = 'foodgram.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': os.getenv('DB_ENGINE', 'django.db.backends.postgresql'),
         'NAME': os.getenv('DB_NAME', 'django'),
         'USER': os.getenv('POSTGRES_USER', 'django'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'django'),
-        'HOST': 'db',
-        'PORT': os.getenv('DB_PORT', 5432)
+        'HOST': os.getenv('DB_HOST', 'db'),
+        'PORT': os.getenv('DB_PORT', 5432),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        # pgbouncer в режиме transaction не держит серверные курсоры
+        # между транзакциями, поэтому iterator() читает обычным курсором.
+        'DISABLE_SERVER_SIDE_CURSORS': bool(
+            int(os.getenv('DB_PGBOUNCER', '0'))
+        ),
     }
 }
 
+if os.getenv('DB_REPLICA_HOST') or os.getenv('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'HOST': os.getenv('DB_REPLICA_HOST', DATABASES['default']['HOST']),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['foodgram.db.ReadReplicaRouter']
+
+DB_CONN_HEALTH_CHECKS = bool(int(os.getenv('DB_CONN_HEALTH_CHECKS', '1')))
+DB_CONN_HEALTH_CHECK_INTERVAL = int(
+    os.getenv('DB_CONN_HEALTH_CHECK_INTERVAL', 30)
+)
+DB_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 10))
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+API_CACHE_TIMEOUT = int(os.getenv('API_CACHE_TIMEOUT', 60 * 60))
+RECIPE_STATE_TIMEOUT = int(os.getenv('RECIPE_STATE_TIMEOUT', 24 * 60 * 60))
+RECIPE_REPRESENTATION_TIMEOUT = int(
+    os.getenv('RECIPE_REPRESENTATION_TIMEOUT', 24 * 60 * 60)
+)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -95,8 +136,17 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
     ],
 
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.CustomPagination',
     'PAGE_SIZE': 6,
+
+    # Перед бэкендом стоит nginx: адрес клиента - последняя запись
+    # X-Forwarded-For, остальные мог подставить сам клиент.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 1)),
 }
 
 DJOSER = {
@@ -118,6 +168,65 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+INGREDIENT_AUTOCOMPLETE_LIMIT = int(
+    os.getenv('INGREDIENT_AUTOCOMPLETE_LIMIT', 20)
+)
+
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 2))
+BACKGROUND_TASKS_SYNC = bool(int(os.getenv('BACKGROUND_TASKS_SYNC', '0')))
+TASK_MAX_ATTEMPTS = int(os.getenv('TASK_MAX_ATTEMPTS', 5))
+TASK_RETRY_BACKOFF = int(os.getenv('TASK_RETRY_BACKOFF', 5))
+TASK_RETRY_BACKOFF_MAX = int(os.getenv('TASK_RETRY_BACKOFF_MAX', 3600))
+TASK_TIMEOUT = int(os.getenv('TASK_TIMEOUT', 600))
+
+FEED_LENGTH = int(os.getenv('FEED_LENGTH', 500))
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 1000))
+
+RECIPE_MATCH_INDEX_TTL = int(os.getenv('RECIPE_MATCH_INDEX_TTL', 600))
+
+SEARCH_RESULTS_LIMIT = int(os.getenv('SEARCH_RESULTS_LIMIT', 1000))
+
+# Включается в foodgram/asgi.py: чтение рецептов, тегов и ингредиентов
+# идёт через async-вьюхи и пул потоков.
+ASYNC_READ_VIEWS = bool(int(os.getenv('ASYNC_READ_VIEWS', '0')))
+
+QUERY_BUDGET_RAISE = bool(int(os.getenv('QUERY_BUDGET_RAISE', '0')))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Лимиты в скользящем окне: запросов за период по пользователю и IP.
+THROTTLE_CACHE = os.getenv('THROTTLE_CACHE', 'default')
+THROTTLE_TOGGLE_RATES = {
+    'user': os.getenv('THROTTLE_TOGGLE_USER_RATE', '30/min'),
+    'ip': os.getenv('THROTTLE_TOGGLE_IP_RATE', '120/min'),
+}
+THROTTLE_RATES = {
+    action: THROTTLE_TOGGLE_RATES
+    for action in (
+        'favorite', 'favorite_bulk', 'clear_favorite',
+        'shopping_cart', 'shopping_cart_bulk', 'clear_shopping_cart',
+        'subscribe', 'subscribe_bulk', 'clear_subscriptions',
+    )
+}
+
+BULK_MAX_IDS = int(os.getenv('BULK_MAX_IDS', 100))
+
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', 5))
+COMPRESSION_STREAM_CHUNK_SIZE = 16 * 1024
+COMPRESSION_CONTENT_TYPES = (
+    'application/json',
+    'text/html',
+    'text/plain',
+    'text/csv',
+    'text/css',
+    'application/javascript',
+)
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
 LANGUAGE_CODE = 'en-us'
 
 TIME_ZONE = 'UTC'
@@ -1,8 +1,48 @@
 from django.contrib import admin
 from django.contrib.admin import display
+from django.db import transaction
 
-from .models import (Favourite, Ingredient, Recipe, RecipeIngredients,
-                     ShoppingCart, Tag)
+from .models import (BackgroundTask, Favourite, FeedEntry, Ingredient, Recipe,
+                     RecipeIngredients, ShoppingCart, ShoppingCartIngredient,
+                     Tag)
+
+
+class CartAggregateMixin:
+    """Пересчитывает сводные списки покупок после правок в админке.
+
+    API обновляет их сам в тех же транзакциях. Пользователи ищутся до
+    изменения: удаление рецепта каскадом удаляет и записи корзины.
+    """
+    cart_users_lookup = None
+
+    def get_cart_users(self, queryset):
+        return set(queryset.filter(
+            **{f'{self.cart_users_lookup}__isnull': False}
+        ).values_list(self.cart_users_lookup, flat=True))
+
+    def rebuild_carts(self, users):
+        if users:
+            ShoppingCartIngredient.objects.rebuild(users)
+
+    def save_model(self, request, obj, form, change):
+        users = set()
+        if change:
+            users = self.get_cart_users(self.model.objects.filter(pk=obj.pk))
+        super().save_model(request, obj, form, change)
+        self.rebuild_carts(
+            users | self.get_cart_users(self.model.objects.filter(pk=obj.pk))
+        )
+
+    def delete_model(self, request, obj):
+        users = self.get_cart_users(self.model.objects.filter(pk=obj.pk))
+        super().delete_model(request, obj)
+        self.rebuild_carts(users)
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        users = self.get_cart_users(queryset)
+        super().delete_queryset(request, queryset)
+        self.rebuild_carts(users)
 
 
 @admin.register(Ingredient)
@@ -27,7 +67,8 @@ class TagAdmin(admin.ModelAdmin):
 
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
+class RecipeAdmin(CartAggregateMixin, admin.ModelAdmin):
+    cart_users_lookup = 'shopping_cart__user'
     list_display = [
         'name',
         'id',
@@ -47,11 +88,12 @@ class RecipeAdmin(admin.ModelAdmin):
 
     @display(description='Количество в избранных')
     def added_in_favorites(self, obj):
-        return obj.favorites.count()
+        return obj.favorites_count
 
 
 @admin.register(RecipeIngredients)
-class RecipeIngredientsAdmin(admin.ModelAdmin):
+class RecipeIngredientsAdmin(CartAggregateMixin, admin.ModelAdmin):
+    cart_users_lookup = 'recipe__shopping_cart__user'
     list_display = [
         'recipe',
         'ingredient',
@@ -68,8 +110,42 @@ class FavouriteAdmin(admin.ModelAdmin):
 
 
 @admin.register(ShoppingCart)
-class ShoppingCartAdmin(admin.ModelAdmin):
+class ShoppingCartAdmin(CartAggregateMixin, admin.ModelAdmin):
+    cart_users_lookup = 'user'
+    list_display = [
+        'user',
+        'recipe'
+    ]
+
+
+@admin.register(ShoppingCartIngredient)
+class ShoppingCartIngredientAdmin(admin.ModelAdmin):
+    list_display = [
+        'user',
+        'ingredient',
+        'amount'
+    ]
+
+
+@admin.register(FeedEntry)
+class FeedEntryAdmin(admin.ModelAdmin):
     list_display = [
         'user',
         'recipe'
     ]
+
+
+@admin.register(BackgroundTask)
+class BackgroundTaskAdmin(admin.ModelAdmin):
+    list_display = [
+        'name',
+        'args',
+        'status',
+        'attempts',
+        'run_at'
+    ]
+
+    list_filter = [
+        'status',
+        'name'
+    ]
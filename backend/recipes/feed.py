@@ -0,0 +1,36 @@
+from django.conf import settings
+
+from recipes.models import FeedEntry, Recipe
+from recipes.tasks import run_on_commit, task
+from users.models import Subscribe
+
+
+@task
+def fan_out_recipe(recipe_id):
+    """Раскладывает новый рецепт по лентам подписчиков автора.
+
+    Рецепты авторов, у которых подписчиков больше FEED_FANOUT_LIMIT, не
+    рассылаются и читаются из подписок при запросе ленты.
+    """
+    author = Recipe.objects.filter(id=recipe_id).values_list(
+        'author_id', 'author__followers_count'
+    ).first()
+    if author is None or author[0] is None:
+        return
+    author_id, followers_count = author
+    if followers_count > settings.FEED_FANOUT_LIMIT:
+        return
+    user_ids = list(Subscribe.objects.filter(
+        author_id=author_id
+    ).values_list('user_id', flat=True))
+    FeedEntry.objects.bulk_create(
+        [FeedEntry(user_id=user_id, recipe_id=recipe_id)
+         for user_id in user_ids],
+        ignore_conflicts=True
+    )
+    FeedEntry.objects.trim(user_ids)
+    Recipe.objects.filter(id=recipe_id).update(fanned_out=True)
+
+
+def schedule_fan_out(recipe):
+    run_on_commit(fan_out_recipe, recipe.id, key=f'feed:{recipe.id}')
@@ -0,0 +1,87 @@
+from io import BytesIO
+from pathlib import PurePosixPath
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image
+
+from recipes.models import Recipe
+from recipes.tasks import run_on_commit, task
+
+
+VARIANTS = {
+    'thumbnail': (200, 200),
+    'medium': (600, 600),
+}
+VARIANTS_DIR = 'recipes/variants'
+
+
+def render_variant(image, size, image_format):
+    variant = image.copy()
+    variant.thumbnail(size, Image.LANCZOS)
+    if image_format == 'JPEG' and variant.mode not in ('RGB', 'L'):
+        variant = variant.convert('RGB')
+    buffer = BytesIO()
+    variant.save(buffer, format=image_format, quality=85)
+    return buffer.getvalue()
+
+
+@task
+def generate_variants(recipe_id, stale_variants=None):
+    """Сохраняет уменьшенные копии изображения рецепта и WebP-версии.
+
+    Пути к файлам записываются в Recipe.image_variants, только если
+    изображение рецепта не сменилось, пока шла обработка. Затем
+    удаляются копии, которые рецепт больше не отдаёт, в том числе
+    stale_variants - копии изображения до замены.
+    """
+    recipe = Recipe.objects.filter(id=recipe_id).only(
+        'image', 'image_variants'
+    ).first()
+    if recipe is None or not recipe.image:
+        delete_variants(stale_variants)
+        return
+    with recipe.image.open('rb') as file:
+        image = Image.open(file)
+        image.load()
+    image_format = 'JPEG' if image.format == 'JPEG' else 'PNG'
+    extension = image_format.lower().replace('jpeg', 'jpg')
+    stem = PurePosixPath(recipe.image.name).stem
+
+    variants = {}
+    for name, size in VARIANTS.items():
+        variants[name] = {}
+        for key, variant_format, variant_extension in (
+            ('original', image_format, extension),
+            ('webp', 'WEBP', 'webp'),
+        ):
+            path = default_storage.save(
+                f'{VARIANTS_DIR}/{stem}_{name}.{variant_extension}',
+                ContentFile(render_variant(image, size, variant_format))
+            )
+            variants[name][key] = path
+
+    with transaction.atomic():
+        current = Recipe.objects.select_for_update().filter(
+            id=recipe_id, image=recipe.image.name
+        ).only('image', 'image_variants').first()
+        if current is not None:
+            current.image_variants = variants
+            current.save(update_fields=['image_variants'])
+    delete_variants(recipe.image_variants if current else variants)
+    delete_variants(stale_variants)
+
+
+def delete_variants(variants):
+    for formats in (variants or {}).values():
+        for path in formats.values():
+            default_storage.delete(path)
+
+
+def schedule_variants(recipe, stale_variants=None):
+    """Запускает обработку изображения после коммита транзакции."""
+    run_on_commit(
+        generate_variants, recipe.id, stale_variants,
+        key=f'images:{recipe.id}'
+    )
@@ -1,22 +1,135 @@
 import csv
+import json
+import re
+from itertools import islice
+from pathlib import Path
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.cache import invalidate
 from recipes.models import Ingredient
 
 
+READ_SIZE = 64 * 1024
+SEPARATOR = re.compile(r'[\s,]*')
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if len(row) >= 2:
+            yield row[0], row[1]
+        else:
+            yield None
+
+
+def read_json(file):
+    """Читает JSON-массив объектов по частям, не загружая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = file.read(READ_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('Ожидается JSON-массив ингредиентов.')
+    position = 1
+    while True:
+        position = SEPARATOR.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            chunk = file.read(READ_SIZE)
+            if not chunk:
+                raise CommandError('Файл JSON оборван или повреждён.')
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if isinstance(item, dict):
+            yield item.get('name'), item.get('measurement_unit')
+        else:
+            yield None
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+}
+
+
 class Command(BaseCommand):
+    help = 'Загружает ингредиенты из CSV или JSON файла.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            default=str(Path(settings.BASE_DIR) / 'data' / 'ingredients.csv')
+        )
+        parser.add_argument('--format', choices=READERS,
+                            help='По умолчанию определяется по расширению.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать, ничего не записывать.')
 
     def handle(self, *args, **options):
-        self.import_ingredients()
-        print('Загрузка ингредиентов завершена.')
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path.name}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть больше 0.')
 
-    def import_ingredients(self, file='ingredients.csv'):
-        print(f'Загрузка данных из {file}')
-        path = f'./data/{file}'
+        self.stdout.write(f'Загрузка данных из {path}')
+        self.processed = self.inserted = self.invalid = self.duplicates = 0
+        # Пары, уже встреченные в файле: повтор из другой пачки иначе
+        # считался бы в пробном запуске новым.
+        self.seen = set()
+        before = Ingredient.objects.count()
         with open(path, newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                status, created = Ingredient.objects.update_or_create(
-                    name=row[0],
-                    measurement_unit=row[1]
-                )
+            rows = READERS[file_format](f)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.import_batch(batch, options['dry_run'])
+                self.stdout.write(f'Обработано строк: {self.processed}')
+
+        if not options['dry_run']:
+            self.inserted = Ingredient.objects.count() - before
+            invalidate('ingredients')
+        existing = (self.processed - self.inserted - self.invalid
+                    - self.duplicates)
+        prefix = ''
+        if options['dry_run']:
+            prefix = 'Пробный запуск, ничего не записано. '
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Загрузка ингредиентов завершена. '
+            f'Добавлено: {self.inserted}, уже были в базе: {existing}, '
+            f'повторов в файле: {self.duplicates}, '
+            f'с ошибками: {self.invalid}.'
+        ))
+
+    def import_batch(self, batch, dry_run):
+        self.processed += len(batch)
+        ingredients = set()
+        for row in batch:
+            if row is None or not row[0] or not row[1]:
+                self.invalid += 1
+                continue
+            ingredient = (row[0].strip(), row[1].strip())
+            if ingredient in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add(ingredient)
+            ingredients.add(ingredient)
+
+        if dry_run:
+            existing = set(Ingredient.objects.filter(
+                name__in={name for name, _ in ingredients}
+            ).values_list('name', 'measurement_unit'))
+            self.inserted += len(ingredients - existing)
+            return
+
+        Ingredient.objects.bulk_create(
+            [Ingredient(name=name, measurement_unit=unit)
+             for name, unit in ingredients],
+            ignore_conflicts=True
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from recipes.models import ShoppingCartIngredient
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сводные списки покупок всех пользователей.'
+
+    def handle(self, *args, **options):
+        ShoppingCartIngredient.objects.rebuild()
+        count = ShoppingCartIngredient.objects.count()
+        self.stdout.write(f'Списки покупок пересчитаны: {count} строк.')
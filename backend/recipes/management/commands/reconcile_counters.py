@@ -0,0 +1,39 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from recipes.models import Favourite, Recipe, ShoppingCart
+from users.models import Subscribe
+
+
+User = get_user_model()
+
+
+def count_of(queryset, field):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+            field
+        ).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField()
+    ), 0)
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает счётчики избранного, корзин, рецептов и '
+            'подписчиков. Запускается периодически по расписанию.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.update(
+            favorites_count=count_of(Favourite.objects, 'recipe'),
+            shopping_cart_count=count_of(ShoppingCart.objects, 'recipe'),
+        )
+        users = User.objects.update(
+            recipes_count=count_of(Recipe.objects, 'author'),
+            followers_count=count_of(Subscribe.objects, 'author'),
+        )
+        self.stdout.write(
+            f'Счётчики пересчитаны: рецептов {recipes}, '
+            f'пользователей {users}.'
+        )
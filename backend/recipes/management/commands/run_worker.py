@@ -0,0 +1,75 @@
+import multiprocessing
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from recipes.models import BackgroundTask
+from recipes.tasks import complete, execute, fail
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи из очереди в пуле процессов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            default=settings.BACKGROUND_WORKERS)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить готовые задачи и выйти.')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        poll_interval = options['poll_interval']
+        # spawn: дочерние процессы открывают свои соединения с базой, а не
+        # наследуют сокеты родителя.
+        pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup
+        )
+        # SIGTERM от docker останавливает воркер так же, как Ctrl+C.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.stdout.write(f'Воркер запущен, процессов: {processes}.')
+        running = {}
+        try:
+            while True:
+                BackgroundTask.objects.requeue_stale(settings.TASK_TIMEOUT)
+                free = processes - len(running)
+                if free:
+                    for background_task in BackgroundTask.objects.claim(free):
+                        future = pool.submit(
+                            execute, background_task.name, background_task.args
+                        )
+                        running[future] = background_task
+                close_old_connections()
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                done, _ = wait(
+                    running, timeout=poll_interval,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    self.finish(running.pop(future), future.exception())
+        except KeyboardInterrupt:
+            self.stdout.write('Остановка воркера.')
+        finally:
+            pool.shutdown(wait=True)
+            for future, background_task in running.items():
+                self.finish(background_task, future.exception())
+
+    def finish(self, background_task, error):
+        if error is None:
+            complete(background_task)
+            return
+        fail(background_task, error)
+        self.stderr.write(
+            f'{background_task}: попытка {background_task.attempts} '
+            f'не удалась: {error}'
+        )
@@ -1,11 +1,20 @@
+from datetime import timedelta
+
 from colorfield.fields import ColorField
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import UniqueConstraint
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (BooleanField, Exists, F, OuterRef, Prefetch, Q,
+                              Sum, UniqueConstraint, Value)
+from django.utils import timezone
+
+from foodgram.db import CountedLinkQuerySet
+from users.models import Subscribe
 
 
 LENGTH_FIELD_DB = 200
+POPULAR_ORDERING = ('-favorites_count', '-id')
 User = get_user_model()
 
 
@@ -58,6 +67,83 @@ class Tag(models.Model):
         return self.name
 
 
+def get_recipe_prefetches():
+    """Связи рецепта, которые нужны для полного представления."""
+    return (
+        'tags',
+        Prefetch(
+            'ingredient_list',
+            queryset=RecipeIngredients.objects.select_related(
+                'ingredient'
+            ).order_by('ingredient__name')
+        ),
+    )
+
+
+class RecipeQuerySet(models.QuerySet):
+
+    def feed(self, user):
+        """Рецепты авторов, на которых подписан пользователь.
+
+        Разосланные рецепты берутся из его ленты, остальные - напрямую
+        по подпискам: так читаются авторы с большим числом подписчиков и
+        рецепты, которые ещё не успели разослать.
+        """
+        return self.filter(
+            Q(id__in=FeedEntry.objects.filter(
+                user=user
+            ).values('recipe'))
+            | Q(fanned_out=False, author__in=Subscribe.objects.filter(
+                user=user
+            ).values('author'))
+        )
+
+    def with_author_subscription(self, user):
+        if user.is_anonymous:
+            return self.annotate(
+                is_author_subscribed=Value(
+                    False, output_field=BooleanField()
+                )
+            )
+        return self.annotate(
+            is_author_subscribed=Exists(Subscribe.objects.filter(
+                user=user, author=OuterRef('author')
+            ))
+        )
+
+    def latest_by_author(self, author_ids, limit=None):
+        """Последние рецепты каждого автора одним запросом.
+
+        С ограничением берём не больше limit рецептов на автора через
+        ROW_NUMBER() OVER (PARTITION BY author_id), а если база не
+        поддерживает оконные функции - отсекаем лишнее в Python.
+        """
+        recipes = {author_id: [] for author_id in author_ids}
+        if not recipes:
+            return recipes
+        features = connections[self.db].features
+        if limit is not None and features.supports_over_clause:
+            quote = connections[self.db].ops.quote_name
+            placeholders = ', '.join(['%s'] * len(recipes))
+            rows = self.raw(
+                f'SELECT * FROM ('
+                f'SELECT *, ROW_NUMBER() OVER ('
+                f'PARTITION BY {quote("author_id")} '
+                f'ORDER BY {quote("id")} DESC) AS row_number '
+                f'FROM {quote(self.model._meta.db_table)} '
+                f'WHERE {quote("author_id")} IN ({placeholders})'
+                f') AS ranked WHERE row_number <= %s '
+                f'ORDER BY {quote("id")} DESC',
+                [*recipes, limit]
+            )
+        else:
+            rows = self.filter(author_id__in=recipes).order_by('-id')
+        for recipe in rows:
+            if limit is None or len(recipes[recipe.author_id]) < limit:
+                recipes[recipe.author_id].append(recipe)
+        return recipes
+
+
 class Recipe(models.Model):
     name = models.CharField(
         'Название',
@@ -81,6 +167,31 @@ class Recipe(models.Model):
         upload_to='recipes/'
     )
 
+    favorites_count = models.PositiveIntegerField(
+        'Количество в избранном',
+        default=0,
+        editable=False
+    )
+
+    shopping_cart_count = models.PositiveIntegerField(
+        'Количество в корзинах',
+        default=0,
+        editable=False
+    )
+
+    fanned_out = models.BooleanField(
+        'Разослан в ленты подписчиков',
+        default=False,
+        editable=False
+    )
+
+    image_variants = models.JSONField(
+        'Уменьшенные изображения',
+        default=dict,
+        blank=True,
+        editable=False
+    )
+
     cooking_time = models.PositiveSmallIntegerField(
         'Время приготовления',
         validators=[
@@ -102,10 +213,22 @@ class Recipe(models.Model):
         verbose_name='Теги'
     )
 
+    objects = RecipeQuerySet.as_manager()
+
     class Meta:
         ordering = ('-id',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = (
+            models.Index(
+                fields=('author', '-id'),
+                name='recipe_author_id_idx'
+            ),
+            models.Index(
+                fields=('-favorites_count', '-id'),
+                name='recipe_popular_idx'
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -147,6 +270,10 @@ class RecipeIngredients(models.Model):
         return f'{self.recipe} нужны {self.ingredient} - {self.amount}'
 
 
+class UsersRecipeQuerySet(CountedLinkQuerySet):
+    target_field = 'recipe'
+
+
 class AbstractUsersRecipe(models.Model):
     user = models.ForeignKey(
         User,
@@ -159,6 +286,8 @@ class AbstractUsersRecipe(models.Model):
         verbose_name='Рецепт',
     )
 
+    objects = UsersRecipeQuerySet.as_manager()
+
     class Meta:
         abstract = True
         constraints = [
@@ -173,6 +302,8 @@ class AbstractUsersRecipe(models.Model):
 
 
 class Favourite(AbstractUsersRecipe):
+    counter_field = 'favorites_count'
+
     class Meta(AbstractUsersRecipe.Meta):
         default_related_name = 'favorites'
         verbose_name = 'Избранное'
@@ -180,7 +311,338 @@ class Favourite(AbstractUsersRecipe):
 
 
 class ShoppingCart(AbstractUsersRecipe):
+    counter_field = 'shopping_cart_count'
+
     class Meta(AbstractUsersRecipe.Meta):
         default_related_name = 'shopping_cart'
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзина'
+
+
+class ShoppingCartIngredientQuerySet(models.QuerySet):
+
+    @transaction.atomic
+    def apply_recipes(self, user, recipes, sign):
+        amounts = dict(RecipeIngredients.objects.filter(
+            recipe__in=recipes
+        ).values('ingredient_id').annotate(
+            total=Sum('amount')
+        ).order_by().values_list('ingredient_id', 'total'))
+        if sign > 0:
+            # Недостающие строки создаются с нулём до блокировки: при двух
+            # одновременных первых добавлениях вторая вставка пропускается,
+            # а суммы обе транзакции прибавляют уже под блокировкой строки.
+            self.bulk_create(
+                [self.model(user=user, ingredient_id=ingredient_id, amount=0)
+                 for ingredient_id in amounts],
+                ignore_conflicts=True
+            )
+        rows = self.select_for_update().filter(
+            user=user, ingredient_id__in=amounts
+        )
+        to_update, to_delete = [], []
+        for row in rows:
+            row.amount += sign * amounts[row.ingredient_id]
+            if row.amount > 0:
+                to_update.append(row)
+            else:
+                to_delete.append(row.id)
+        self.bulk_update(to_update, ['amount'])
+        self.filter(id__in=to_delete).delete()
+
+    def add_recipes(self, user, recipes):
+        self.apply_recipes(user, recipes, 1)
+
+    def remove_recipes(self, user, recipes):
+        self.apply_recipes(user, recipes, -1)
+
+    @transaction.atomic
+    def rebuild(self, users=None):
+        carts = {'recipe__shopping_cart__isnull': False}
+        stale = self.all()
+        if users is not None:
+            carts = {'recipe__shopping_cart__user__in': users}
+            stale = stale.filter(user__in=users)
+        stale.delete()
+        self.bulk_create([
+            self.model(user_id=row['recipe__shopping_cart__user'],
+                       ingredient_id=row['ingredient'],
+                       amount=row['total'])
+            for row in RecipeIngredients.objects.filter(**carts).values(
+                'recipe__shopping_cart__user', 'ingredient'
+            ).annotate(total=Sum('amount')).order_by()
+        ])
+
+
+class ShoppingCartIngredient(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_ingredients',
+        verbose_name='Пользователь',
+    )
+
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент'
+    )
+
+    amount = models.PositiveIntegerField('Количество')
+
+    objects = ShoppingCartIngredientQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Ингредиент корзины'
+        verbose_name_plural = 'Ингредиенты корзины'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_cart_ingredient'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} :: {self.ingredient} - {self.amount}'
+
+
+class FeedEntryQuerySet(models.QuerySet):
+
+    def follow(self, user, authors):
+        recipe_ids = Recipe.objects.filter(
+            author__in=authors, fanned_out=True
+        ).values_list('id', flat=True)[:settings.FEED_LENGTH]
+        self.bulk_create(
+            [self.model(user=user, recipe_id=recipe_id)
+             for recipe_id in recipe_ids],
+            ignore_conflicts=True
+        )
+        self.trim([user.id])
+
+    def unfollow(self, user, authors):
+        self.filter(user=user, recipe__author__in=authors).delete()
+
+    def trim(self, user_ids):
+        """Оставляет в лентах пользователей FEED_LENGTH последних записей."""
+        connection = connections[self.db]
+        if not user_ids or not connection.features.supports_over_clause:
+            return
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        placeholders = ', '.join(['%s'] * len(user_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE {quote("id")} IN ('
+                f'SELECT {quote("id")} FROM ('
+                f'SELECT {quote("id")}, ROW_NUMBER() OVER ('
+                f'PARTITION BY {quote("user_id")} '
+                f'ORDER BY {quote("recipe_id")} DESC) AS row_number '
+                f'FROM {table} '
+                f'WHERE {quote("user_id")} IN ({placeholders})'
+                f') AS ranked WHERE row_number > %s)',
+                [*user_ids, settings.FEED_LENGTH]
+            )
+
+
+class FeedEntry(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed',
+        verbose_name='Пользователь',
+    )
+
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт',
+    )
+
+    objects = FeedEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} :: {self.recipe}'
+
+
+class RecipeSearchDocument(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name='Рецепт',
+    )
+
+    name = models.CharField(
+        'Название',
+        max_length=LENGTH_FIELD_DB
+    )
+
+    ingredients = models.TextField('Ингредиенты')
+
+    text = models.TextField('Описание')
+
+    class Meta:
+        verbose_name = 'Поисковый документ рецепта'
+        verbose_name_plural = 'Поисковые документы рецептов'
+
+    def __str__(self):
+        return self.name
+
+
+class BackgroundTaskQuerySet(models.QuerySet):
+
+    def enqueue(self, name, args, key=None):
+        """Ставит задачу в очередь одним INSERT.
+
+        Пока в очереди есть задача с тем же ключом, новая не добавляется.
+        """
+        self.bulk_create(
+            [BackgroundTask(name=name, args=list(args), key=key)],
+            ignore_conflicts=True
+        )
+
+    def claim(self, limit):
+        """Забирает до limit готовых задач в работу.
+
+        Задача переводится в RUNNING условным UPDATE, поэтому несколько
+        воркеров не возьмут одну и ту же задачу и без SELECT FOR UPDATE.
+        """
+        now = timezone.now()
+        candidates = self.filter(
+            status=BackgroundTask.PENDING, run_at__lte=now
+        ).order_by('run_at', 'id').values_list('id', flat=True)[:limit * 2]
+        claimed = []
+        for pk in candidates:
+            updated = self.filter(
+                id=pk, status=BackgroundTask.PENDING
+            ).update(
+                status=BackgroundTask.RUNNING,
+                locked_at=now,
+                attempts=F('attempts') + 1
+            )
+            if updated:
+                claimed.append(pk)
+                if len(claimed) == limit:
+                    break
+        return list(self.filter(id__in=claimed).order_by('run_at', 'id'))
+
+    def requeue_stale(self, timeout):
+        """Возвращает в очередь задачи упавших воркеров."""
+        stale = self.filter(
+            status=BackgroundTask.RUNNING,
+            locked_at__lt=timezone.now() - timedelta(seconds=timeout)
+        )
+        for task in stale:
+            task.reschedule(timezone.now())
+
+
+class BackgroundTask(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (FAILED, 'Ошибка'),
+    )
+
+    name = models.CharField(
+        'Задача',
+        max_length=LENGTH_FIELD_DB
+    )
+
+    args = models.JSONField(
+        'Аргументы',
+        default=list
+    )
+
+    key = models.CharField(
+        'Ключ идемпотентности',
+        max_length=LENGTH_FIELD_DB,
+        null=True,
+        blank=True
+    )
+
+    status = models.CharField(
+        'Статус',
+        max_length=16,
+        choices=STATUSES,
+        default=PENDING
+    )
+
+    attempts = models.PositiveSmallIntegerField(
+        'Попыток',
+        default=0
+    )
+
+    run_at = models.DateTimeField(
+        'Выполнить не раньше',
+        default=timezone.now
+    )
+
+    locked_at = models.DateTimeField(
+        'Взята в работу',
+        null=True,
+        blank=True
+    )
+
+    last_error = models.TextField(
+        'Последняя ошибка',
+        blank=True
+    )
+
+    created_at = models.DateTimeField(
+        'Создана',
+        auto_now_add=True
+    )
+
+    objects = BackgroundTaskQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'],
+                condition=Q(status='pending'),
+                name='unique_pending_task_key'
+            )
+        ]
+        indexes = (
+            models.Index(
+                fields=('status', 'run_at'),
+                name='task_status_run_at_idx'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.name} {self.args}'
+
+    def reschedule(self, run_at, error=''):
+        """Возвращает задачу в очередь.
+
+        Если за это время в очередь встала задача с тем же ключом, она
+        сделает ту же работу, и эта строка просто удаляется.
+        """
+        try:
+            with transaction.atomic():
+                BackgroundTask.objects.filter(id=self.id).update(
+                    status=BackgroundTask.PENDING,
+                    run_at=run_at,
+                    locked_at=None,
+                    last_error=error
+                )
+        except IntegrityError:
+            self.delete()
@@ -0,0 +1,77 @@
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from recipes.models import BackgroundTask
+
+
+def task(func):
+    """Разрешает выполнять функцию воркером по её пути."""
+    func.is_background_task = True
+    return func
+
+
+def get_task_name(func):
+    return f'{func.__module__}.{func.__name__}'
+
+
+def execute(name, args):
+    """Выполняет задачу в процессе воркера."""
+    func = import_string(name)
+    if not getattr(func, 'is_background_task', False):
+        raise ImproperlyConfigured(f'{name} не помечена как @task.')
+    try:
+        func(*args)
+    finally:
+        close_old_connections()
+
+
+def dispatch(func, args, key):
+    if settings.BACKGROUND_TASKS_SYNC:
+        func(*args)
+    else:
+        BackgroundTask.objects.enqueue(get_task_name(func), args, key)
+
+
+def run_on_commit(func, *args, key=None):
+    """Ставит func(*args) в очередь после коммита текущей транзакции.
+
+    Задачи с одинаковым key внутри одной транзакции ставятся один раз,
+    а в очереди ключ уникален среди ещё не взятых задач. Аргументы
+    должны сериализоваться в JSON. С BACKGROUND_TASKS_SYNC задача
+    выполняется сразу после коммита в этом же процессе.
+    """
+    callback = partial(dispatch, func, args, key)
+    callback.task_key = key
+    connection = transaction.get_connection()
+    if key is not None and connection.in_atomic_block:
+        for entry in connection.run_on_commit:
+            if getattr(entry[1], 'task_key', None) == key:
+                return
+    transaction.on_commit(callback)
+
+
+def complete(background_task):
+    background_task.delete()
+
+
+def fail(background_task, error):
+    """Планирует повтор с экспоненциальной задержкой или сдаётся."""
+    error = f'{type(error).__name__}: {error}'
+    if background_task.attempts >= settings.TASK_MAX_ATTEMPTS:
+        BackgroundTask.objects.filter(id=background_task.id).update(
+            status=BackgroundTask.FAILED, locked_at=None, last_error=error
+        )
+        return
+    delay = min(
+        settings.TASK_RETRY_BACKOFF * 2 ** (background_task.attempts - 1),
+        settings.TASK_RETRY_BACKOFF_MAX
+    )
+    background_task.reschedule(
+        timezone.now() + timedelta(seconds=delay), error
+    )
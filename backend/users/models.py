@@ -1,7 +1,9 @@
 from django.contrib.auth.models import AbstractUser
 
 from django.db import models
-from django.db.models import UniqueConstraint
+from django.db.models import Index, UniqueConstraint
+
+from foodgram.db import CountedLinkQuerySet
 
 
 class User(AbstractUser):
@@ -26,6 +28,18 @@ class User(AbstractUser):
         unique=True,
     )
 
+    recipes_count = models.PositiveIntegerField(
+        'количество рецептов',
+        default=0,
+        editable=False
+    )
+
+    followers_count = models.PositiveIntegerField(
+        'количество подписчиков',
+        default=0,
+        editable=False
+    )
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = (
         'username',
@@ -42,7 +56,13 @@ class User(AbstractUser):
         return self.username
 
 
+class SubscribeQuerySet(CountedLinkQuerySet):
+    target_field = 'author'
+
+
 class Subscribe(models.Model):
+    counter_field = 'followers_count'
+
     user = models.ForeignKey(
         User,
         verbose_name='Подписчик',
@@ -57,6 +77,8 @@ class Subscribe(models.Model):
         on_delete=models.CASCADE,
     )
 
+    objects = SubscribeQuerySet.as_manager()
+
     class Meta:
         ordering = ('-id',)
         constraints = (
@@ -65,5 +87,9 @@ class Subscribe(models.Model):
                 name='unique_subscription'
             ),
         )
+        indexes = (
+            Index(fields=('user', '-id'), name='subscribe_user_id_idx'),
+            Index(fields=('author', 'user'), name='subscribe_author_user_idx'),
+        )
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'